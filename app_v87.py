@@ -14,91 +14,1156 @@ import yfinance as yf
 import plotly.graph_objects as go
 from plotly.subplots import make_subplots
 import io
+import copy
+import random
+import functools
+import bisect
+import threading
+import sqlite3
+from concurrent.futures import ThreadPoolExecutor, as_completed, wait, TimeoutError as FuturesTimeout
+from collections import OrderedDict, deque
+from urllib.parse import urlsplit
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+from requests.adapters import HTTPAdapter
+import lxml.html
 
 import gspread
+from gspread.urls import DRIVE_FILES_API_V3_URL
+from gspread.utils import rowcol_to_a1
 from oauth2client.service_account import ServiceAccountCredentials
 
-# --- Google Sheets 連線設定 ---
+# --- Stale-While-Revalidate 快取 (取代外部資料的 st.cache_data) ---
+# st.cache_data 過期的那一次呼叫會讓使用者卡在網路請求上；
+# swr_cache 過期後立刻回傳上一份好資料，同時在背景 thread 重新抓取。
+class SWRStore:
+    """
+    單一函式的 SWR 快取 (thread-safe，跨 Session 共用)。
+    每個 key 存 (值, 抓取成功時間, 上次嘗試時間, 上次嘗試是否有效)，同一個 key 同時只會有一個背景更新。
+    clock 可替換 (測試用)。
+    """
+    def __init__(self, max_entries, clock=time.time):
+        self.max_entries = max_entries
+        self._clock = clock
+        self._lock = threading.Lock()
+        self._entries = OrderedDict()
+        self._refreshing = set()
+
+    def get(self, key):
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None: self._entries.move_to_end(key)
+            return entry
+
+    def put(self, key, value, is_valid):
+        """新值有效才覆蓋；抓取失敗時保留舊值，只更新嘗試時間並標記失敗 (短期內重試)"""
+        now = self._clock()
+        ok = is_valid(value)
+        with self._lock:
+            old = self._entries.get(key)
+            if old is None or ok or not is_valid(old[0]):
+                self._entries[key] = (value, now, now, ok)
+            else:
+                self._entries[key] = (old[0], old[1], now, False)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+            return self._entries[key]
+
+    def is_refreshing(self, key):
+        with self._lock:
+            return key in self._refreshing
+
+    def _claim(self, key):
+        with self._lock:
+            if key in self._refreshing: return False
+            self._refreshing.add(key)
+            return True
+
+    def _revalidate(self, key, func, args, kwargs, is_valid):
+        try:
+            value = func(*args, **kwargs)
+        except Exception as e:
+            print(f"SWR Refresh Error ({func.__name__}): {e}")
+            value = None
+        try:
+            self.put(key, value, is_valid)
+        finally:
+            with self._lock:
+                self._refreshing.discard(key)
+
+    def revalidate(self, key, func, args, kwargs, is_valid):
+        """同步更新 (給排程 thread 用)；已經有人在更新時直接略過"""
+        if not self._claim(key): return False
+        self._revalidate(key, func, args, kwargs, is_valid)
+        return True
+
+    def revalidate_async(self, key, func, args, kwargs, is_valid):
+        if not self._claim(key): return
+        threading.Thread(target=self._revalidate, args=(key, func, args, kwargs, is_valid), name=f"swr-{func.__name__}", daemon=True).start()
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+@st.cache_resource
+def _get_swr_store(name, max_entries):
+    return SWRStore(max_entries)
+
+def _swr_is_valid(value):
+    # 預設：None / 空 DataFrame / 空容器 (或全部都是空 DataFrame 的 dict) 視為抓取失敗
+    if value is None: return False
+    if isinstance(value, pd.DataFrame): return not value.empty
+    if isinstance(value, dict) and value and all(isinstance(v, pd.DataFrame) for v in value.values()):
+        return any(not v.empty for v in value.values())
+    if isinstance(value, (list, tuple, dict)): return len(value) > 0
+    return True
+
+# --- 快取期限政策 (依台股交易時段) ---
+TW_SESSION_OPEN = (9, 0)
+TW_SESSION_CLOSE = (13, 30)
+TW_SETTLE_DELAY_MIN = 10 # 收盤後多久做最後一次「定案」抓取
+
+class MarketSessionTTL:
+    """
+    依台股 (TWSE/TPEx) 交易時段決定快取期限 (Asia/Taipei)：
+    - 盤中 09:00–13:30：每 session_ttl 秒更新；
+    - 收盤後 TW_SETTLE_DELAY_MIN 分鐘做一次定案抓取；
+    - 其餘時間 (盤後、盤前、週末) 一律沿用到下一個開盤。
+    """
+    def __init__(self, session_ttl):
+        self.session_ttl = session_ttl
+
+    @staticmethod
+    def _at(tz, d, hm, delay_min=0):
+        return tz.localize(datetime(d.year, d.month, d.day, *hm)) + timedelta(minutes=delay_min)
+
+    def expires_at(self, ts):
+        tz = pytz.timezone('Asia/Taipei')
+        t = datetime.fromtimestamp(ts, tz)
+        d = t.date()
+        if d.weekday() < 5:
+            open_dt = self._at(tz, d, TW_SESSION_OPEN)
+            close_dt = self._at(tz, d, TW_SESSION_CLOSE)
+            settle_dt = self._at(tz, d, TW_SESSION_CLOSE, TW_SETTLE_DELAY_MIN)
+            if open_dt <= t < close_dt: return ts + self.session_ttl
+            if t < open_dt: return open_dt.timestamp()
+            if t < settle_dt: return settle_dt.timestamp()
+        # 已定案或休市日：下一個交易日開盤
+        d += timedelta(days=1)
+        while d.weekday() >= 5: d += timedelta(days=1)
+        return self._at(tz, d, TW_SESSION_OPEN).timestamp()
+
+SWR_RETRY_SEC = 60 # 上次抓取失敗 (結果無效) 時多久後重試
+
+def _swr_expires_at(ttl, entry):
+    # ttl 可以是秒數 (24 小時市場，例如加密貨幣) 或 MarketSessionTTL 這類政策物件；
+    # 交易時段的長期限只給有效的資料，上次抓取失敗的一律短期重試，不會被沿用到下一個開盤
+    checked_at = entry[2]
+    if hasattr(ttl, 'expires_at'):
+        return ttl.expires_at(checked_at) if entry[3] else checked_at + SWR_RETRY_SEC
+    return checked_at + (ttl if entry[3] else min(ttl, SWR_RETRY_SEC))
+
+def swr_cache(ttl, max_entries=32, is_valid=_swr_is_valid, stale_if=None):
+    """
+    Stale-While-Revalidate 裝飾器 (ttl 為秒數或 MarketSessionTTL)：
+    - 第一次呼叫 (沒有任何資料) 同步抓取；
+    - 超過 ttl 秒後直接回傳舊值，並在背景更新；
+    - 回傳的是 deep copy，呼叫端修改不會污染快取；
+    - stale_if(value) 為真時不等 ttl，下一次呼叫就在背景更新 (例如資料還沒抓齊)。
+    額外提供 .clear()、.set(value, *args)、.refresh(*args) (同步更新)、.peek(*args) (只讀)、.expires_in(*args)
+    與 .cache_info(*args) (回傳抓取時間與是否過期，給「as of」標籤用)。
+    """
+    def decorator(func):
+        store = _get_swr_store(f"{func.__module__}.{func.__qualname__}", max_entries)
+
+        def make_key(args, kwargs):
+            # 參數可能是 list (例如股票清單)，用 repr 當 key
+            return repr((args, sorted(kwargs.items())))
+
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            key = make_key(args, kwargs)
+            entry = store.get(key)
+            if entry is None:
+                entry = store.put(key, func(*args, **kwargs), is_valid)
+            elif time.time() >= _swr_expires_at(ttl, entry) or (stale_if is not None and stale_if(entry[0])):
+                store.revalidate_async(key, func, args, kwargs, is_valid)
+            return copy.deepcopy(entry[0])
+
+        def cache_info(*args, **kwargs):
+            key = make_key(args, kwargs)
+            entry = store.get(key)
+            if entry is None: return None
+            stale = not entry[3] or time.time() >= _swr_expires_at(ttl, entry) or store.is_refreshing(key)
+            return {"fetched_at": entry[1], "stale": stale}
+
+        def expires_in(*args, **kwargs):
+            """距離過期還有幾秒 (沒有資料時回傳 None)"""
+            entry = store.get(make_key(args, kwargs))
+            if entry is None: return None
+            if stale_if is not None and stale_if(entry[0]): return 0
+            return _swr_expires_at(ttl, entry) - time.time()
+
+        def peek(*args, **kwargs):
+            """只讀快取 (deep copy)，不觸發任何抓取；沒有資料時回傳 None"""
+            entry = store.get(make_key(args, kwargs))
+            return None if entry is None else copy.deepcopy(entry[0])
+
+        def refresh(*args, **kwargs):
+            return store.revalidate(make_key(args, kwargs), func, args, kwargs, is_valid)
+
+        def set_value(value, *args, **kwargs):
+            # 呼叫端自己抓好資料時 (例如逐步渲染) 直接寫回快取
+            store.put(make_key(args, kwargs), value, is_valid)
+
+        wrapper.clear = store.clear
+        wrapper.cache_info = cache_info
+        wrapper.set = set_value
+        wrapper.refresh = refresh
+        wrapper.peek = peek
+        wrapper.expires_in = expires_in
+        return wrapper
+    return decorator
+
+def render_swr_badge(fetcher, *args, **kwargs):
+    """在區塊下方顯示小字「as of HH:MM:SS」，資料過期 (背景更新中) 時加註"""
+    info = fetcher.cache_info(*args, **kwargs)
+    if info is None: return
+    as_of = datetime.fromtimestamp(info['fetched_at'], pytz.timezone('Asia/Taipei')).strftime('%H:%M:%S')
+    if info['stale']:
+        st.caption(f"⏳ as of {as_of} (背景更新中)")
+    else:
+        st.caption(f"🕒 as of {as_of}")
+
+# --- 上游限流 (token bucket) ---
+# host -> (每秒補充的 token 數, 最多可累積的 token 數 = 瞬間可連發的請求數)
+# 可在 secrets 加上 [rate_limits] 覆寫，例如 "mis.twse.com.tw" = [2, 4]；沒列出的 host 不限流
+YF_RATE_HOST = "query1.finance.yahoo.com" # yfinance 的請求 (query1/query2) 共用這個 bucket
+RATE_LIMITS = {
+    YF_RATE_HOST: (5, 20),
+    "mis.twse.com.tw": (2, 4),
+    "production.dataviz.cnn.io": (0.5, 2),
+    "tw.stock.yahoo.com": (2, 4),
+    "sheets.googleapis.com": (1, 10), # Sheets API 每位使用者每分鐘 60 次讀取
+}
+
+class TokenBucket:
+    """
+    每秒補充 rate 個 token、最多累積 burst 個。拿不到 token 時排隊等待而不是失敗：
+    token 可以預支成負數，後到的請求等待時間自然較長 (先到先服務)。
+    clock / sleep 可替換 (測試用)。
+    """
+    def __init__(self, rate, burst, clock=time.monotonic, sleep=time.sleep):
+        self.rate = float(rate)
+        self.burst = float(burst)
+        self._clock = clock
+        self._sleep = sleep
+        self._tokens = self.burst
+        self._updated = clock()
+        self._lock = threading.Lock()
+        self._acquired = 0
+        self._delayed = 0
+        self._queued = 0
+        self._waits_ms = deque(maxlen=200)
+
+    def _reserve(self, cost):
+        # 預約 cost 個 token，回傳需要等待的秒數
+        with self._lock:
+            now = self._clock()
+            self._tokens = min(self.burst, self._tokens + (now - self._updated) * self.rate)
+            self._updated = now
+            self._tokens -= cost
+            wait = max(0.0, -self._tokens / self.rate)
+            self._acquired += 1
+            self._waits_ms.append(wait * 1000)
+            if wait > 0:
+                self._delayed += 1
+                self._queued += 1
+            return wait
+
+    def acquire(self, cost=1):
+        """取得 cost 個 token (超過 burst 以 burst 計)，必要時 sleep；回傳實際等待秒數"""
+        wait = self._reserve(min(float(cost), self.burst))
+        if wait > 0:
+            try: self._sleep(wait)
+            finally:
+                with self._lock: self._queued -= 1
+        return wait
+
+    def stats(self):
+        with self._lock:
+            waits = sorted(self._waits_ms)
+            return {
+                "rate": self.rate, "burst": self.burst,
+                "acquired": self._acquired, "delayed": self._delayed, "queued": self._queued,
+                "avg_wait_ms": round(sum(waits) / len(waits), 1) if waits else None,
+                "p95_wait_ms": round(waits[min(len(waits) - 1, int(len(waits) * 0.95))], 1) if waits else None,
+                "max_wait_ms": round(waits[-1], 1) if waits else None,
+            }
+
+class RateLimiter:
+    """每個上游 host 一個 TokenBucket，跨 Session / thread 共用"""
+    def __init__(self, limits, **bucket_kwargs):
+        self._buckets = {host: TokenBucket(rate, burst, **bucket_kwargs) for host, (rate, burst) in limits.items()}
+
+    def acquire(self, host, cost=1):
+        bucket = self._buckets.get(host)
+        return bucket.acquire(cost) if bucket else 0.0
+
+    def stats(self):
+        return [{"host": host, **bucket.stats()} for host, bucket in self._buckets.items()]
+
+def _rate_limit_config():
+    limits = dict(RATE_LIMITS)
+    try: overrides = st.secrets.get("rate_limits", {})
+    except Exception: overrides = {} # 沒有 secrets 檔
+    for host, (rate, burst) in overrides.items():
+        limits[host] = (float(rate), float(burst))
+    return limits
+
+@st.cache_resource
+def get_rate_limiter():
+    return RateLimiter(_rate_limit_config())
+
+def yf_throttle(cost=1):
+    """yfinance 呼叫前先排隊取 token (yfinance 用自己的 session，不經過 HttpClient)"""
+    return get_rate_limiter().acquire(YF_RATE_HOST, cost)
+
+# --- 上游斷路器 (circuit breaker) ---
+# 來源 -> (連續失敗幾次就斷開, 斷開後冷卻秒數)
+CIRCUIT_BREAKERS = {
+    "mis": (3, 120),          # 證交所 MIS：雲端主機常被擋
+    "yf_fast_info": (5, 60),  # yfinance fast_info 報價
+    "yf_history": (3, 60),    # yfinance 日K/分K (history / download)
+    "yahoo_rank": (3, 120),   # Yahoo 股市成交值排行爬蟲
+    "cnn": (3, 300),          # CNN 恐懼貪婪指數
+}
+
+class CircuitBreaker:
+    """
+    連續失敗 failure_threshold 次後斷開 (open)，冷卻期間 allow() 直接回 False，呼叫端改走下一個來源，
+    不必每次 rerun 都等上游 timeout。冷卻結束後只放行一個試探請求 (half-open)：
+    成功就恢復 (closed)，失敗就再冷卻一輪。試探者沒回報結果時，下一輪冷卻後會再放行一個。
+    clock 可替換 (測試用)。
+    """
+    def __init__(self, name, failure_threshold=3, cooldown=60, clock=time.time):
+        self.name = name
+        self._clock = clock
+        self.failure_threshold = failure_threshold
+        self.cooldown = cooldown
+        self._lock = threading.Lock()
+        self._state = "closed"
+        self._failures = 0
+        self._retry_at = 0.0
+        self._trips = 0
+        self._skipped = 0
+
+    def is_open(self):
+        """冷卻中 (不會放行任何請求)；只讀，不佔用試探名額"""
+        with self._lock:
+            return self._state != "closed" and self._clock() < self._retry_at
+
+    def allow(self):
+        with self._lock:
+            if self._state == "closed": return True
+            now = self._clock()
+            if now < self._retry_at:
+                self._skipped += 1
+                return False
+            # 放行一個試探請求，其他呼叫端在下一輪冷卻結束前仍被擋下
+            self._state = "half_open"
+            self._retry_at = now + self.cooldown
+            return True
+
+    def record(self, ok):
+        with self._lock:
+            if ok:
+                self._state = "closed"
+                self._failures = 0
+                return
+            self._failures += 1
+            if self._state == "half_open" or self._failures >= self.failure_threshold:
+                if self._state == "closed": self._trips += 1
+                self._state = "open"
+                self._retry_at = self._clock() + self.cooldown
+
+    def stats(self):
+        with self._lock:
+            return {
+                "source": self.name, "state": self._state, "failures": self._failures,
+                "trips": self._trips, "skipped": self._skipped,
+                "retry_in_sec": round(max(0.0, self._retry_at - self._clock()), 1) if self._state != "closed" else None,
+            }
+
+@st.cache_resource
+def get_circuit_breakers():
+    return {name: CircuitBreaker(name, *cfg) for name, cfg in CIRCUIT_BREAKERS.items()}
+
+def get_breaker(name):
+    return get_circuit_breakers()[name]
+
+# --- 共用 HTTP 連線池 (爬蟲/官方 API 用) ---
+# 每個 host 一個 keep-alive Session，熱請求不必再做 TCP/TLS 握手
+HTTP_DEFAULT_HEADERS = {
+    "User-Agent": "Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/120.0.0.0 Safari/537.36",
+    "Accept-Encoding": "gzip, deflate",
+}
+HTTP_RETRY_STATUS = {429, 500, 502, 503, 504}
+
+class HttpClient:
+    """
+    跨 Session 共用的 HTTP client (thread-safe)：
+    - 每個 host 一個連線池 (keep-alive + gzip)；
+    - 連線錯誤或 429/5xx 時以 jitter 指數退避重試；
+    - 每次送出 (含重試) 前先向 limiter 取 token，超過配額時排隊而不是失敗；
+    - 記錄每個 host 的請求數、錯誤數與延遲 (stats())。
+    """
+    def __init__(self, limiter=None, retries=2, backoff=0.5, max_backoff=8, pool_size=8):
+        self.limiter = limiter
+        self.retries = retries
+        self.backoff = backoff
+        self.max_backoff = max_backoff
+        self.pool_size = pool_size
+        self._lock = threading.Lock()
+        self._sessions = {}
+        self._stats = {}
+
+    def _session(self, host):
+        with self._lock:
+            session = self._sessions.get(host)
+            if session is None:
+                session = requests.Session()
+                session.headers.update(HTTP_DEFAULT_HEADERS)
+                adapter = HTTPAdapter(pool_connections=1, pool_maxsize=self.pool_size)
+                session.mount("https://", adapter)
+                session.mount("http://", adapter)
+                self._sessions[host] = session
+            return session
+
+    def _counters(self, host):
+        # 呼叫端需持有 self._lock
+        return self._stats.setdefault(host, {'requests': 0, 'errors': 0, 'retries': 0, 'latency_ms': deque(maxlen=200)})
+
+    def _record(self, host, elapsed_ms, ok):
+        with self._lock:
+            counters = self._counters(host)
+            counters['requests'] += 1
+            if not ok: counters['errors'] += 1
+            if elapsed_ms is not None: counters['latency_ms'].append(elapsed_ms)
+
+    def _sleep_before_retry(self, host, attempt, retry_after=None):
+        with self._lock:
+            self._counters(host)['retries'] += 1
+        delay = min(self.max_backoff, self.backoff * (2 ** attempt)) * random.uniform(0.5, 1.5)
+        if retry_after is not None: delay = min(self.max_backoff, max(delay, retry_after))
+        time.sleep(delay)
+
+    def get(self, url, headers=None, timeout=10, retries=None, **kwargs):
+        host = urlsplit(url).netloc
+        session = self._session(host)
+        retries = self.retries if retries is None else retries
+        for attempt in range(retries + 1):
+            if self.limiter is not None: self.limiter.acquire(host)
+            start = time.perf_counter()
+            try:
+                r = session.get(url, headers=headers, timeout=timeout, **kwargs)
+            except requests.RequestException:
+                self._record(host, None, False)
+                if attempt >= retries: raise
+                self._sleep_before_retry(host, attempt)
+                continue
+            self._record(host, (time.perf_counter() - start) * 1000, r.status_code < 400)
+            if r.status_code in HTTP_RETRY_STATUS and attempt < retries:
+                retry_after = r.headers.get("Retry-After")
+                self._sleep_before_retry(host, attempt, float(retry_after) if retry_after and retry_after.isdigit() else None)
+                continue
+            return r
+
+    def stats(self):
+        """每個 host 的請求統計 (給後台顯示)"""
+        with self._lock:
+            rows = []
+            for host, counters in self._stats.items():
+                lat = sorted(counters['latency_ms'])
+                rows.append({
+                    "host": host, "requests": counters['requests'], "errors": counters['errors'], "retries": counters['retries'],
+                    "avg_ms": round(sum(lat) / len(lat), 1) if lat else None,
+                    "p95_ms": round(lat[min(len(lat) - 1, int(len(lat) * 0.95))], 1) if lat else None,
+                    "last_ms": round(counters['latency_ms'][-1], 1) if lat else None,
+                })
+            return rows
+
+@st.cache_resource
+def get_http_client():
+    return HttpClient(limiter=get_rate_limiter())
+
+def render_http_stats():
+    rows = get_http_client().stats()
+    with st.expander("🌐 上游連線統計 (每個 host)", expanded=False):
+        if rows: st.dataframe(pd.DataFrame(rows), hide_index=True, use_container_width=True)
+        else: st.caption("尚無請求紀錄")
+        st.caption("限流等待 (token bucket)")
+        st.dataframe(pd.DataFrame(get_rate_limiter().stats()), hide_index=True, use_container_width=True)
+        st.caption("斷路器狀態")
+        st.dataframe(pd.DataFrame([b.stats() for b in get_circuit_breakers().values()]), hide_index=True, use_container_width=True)
+
+# --- Google Sheets 連線設定 (連線池版：整個 Server 共用同一個已授權 client) ---
+# 定義需要的權限範圍
+GSHEET_SCOPE = ['https://spreadsheets.google.com/feeds', 'https://www.googleapis.com/auth/drive']
+
+class GSheetConnectionManager:
+    """
+    跨 Session 共用的 Google Sheets 連線管理器 (thread-safe)。
+    只做一次 OAuth 授權 (token 過期由 gspread 的 AuthorizedSession 自動 refresh，不必重建 client)，
+    並快取 Spreadsheet / Worksheet handle，讀寫時不必再重新 open。
+    """
+    def __init__(self):
+        self._lock = threading.RLock()
+        self._client = None
+        self._spreadsheet = None
+        self._worksheets = {}
+        # 每個分頁最後一次讀/寫後的原始格子 (字串)，供差異寫入比對用
+        self._snapshots = {}
+        self._snapshot_rev = {}
+        # (分頁, 主鍵欄) -> (標題列, 依試算表順序排列的主鍵清單)，供 upsert 定位列號
+        self._key_index = {}
+        # 每個分頁一把寫入鎖 (invalidate 時不清掉)
+        self._write_locks = {}
+
+    def _ensure_client(self):
+        if self._client is None:
+            # 從 Streamlit Secrets 讀取憑證
+            # 注意：Secrets 裡面的 key 必須對應你的設定，這裡假設是 [gcp_service_account]
+            creds = ServiceAccountCredentials.from_json_keyfile_dict(st.secrets["gcp_service_account"], GSHEET_SCOPE)
+            self._client = gspread.authorize(creds)
+            self._throttle_session(self._client)
+        return self._client
+
+    @staticmethod
+    def _throttle_session(client):
+        # gspread 的所有 API 呼叫都經過同一個 requests session，在這裡統一排隊取 token
+        # (gspread 6 之後 session 搬到 client.http_client)
+        session = getattr(getattr(client, 'http_client', client), 'session', None)
+        if session is None: return
+        send = session.request
+        limiter = get_rate_limiter()
+        @functools.wraps(send)
+        def throttled(method, url, *args, **kwargs):
+            limiter.acquire(urlsplit(url).netloc)
+            return send(method, url, *args, **kwargs)
+        session.request = throttled
+
+    def get_client(self):
+        with self._lock:
+            return self._ensure_client()
+
+    def get_spreadsheet(self):
+        with self._lock:
+            client = self._ensure_client()
+            if self._spreadsheet is None:
+                self._spreadsheet = client.open(st.secrets["sheet_name"])
+            return self._spreadsheet
+
+    def get_worksheet(self, worksheet_name):
+        with self._lock:
+            ws = self._worksheets.get(worksheet_name)
+            if ws is None:
+                ws = self.get_spreadsheet().worksheet(worksheet_name)
+                self._worksheets[worksheet_name] = ws
+            return ws
+
+    def get_revision(self):
+        """試算表目前的版本標記 (Drive modifiedTime)，只打一次 metadata API，不下載內容"""
+        # 不能用 sheet.lastUpdateTime：那是 open 時快取的屬性，handle 被快取後就不會再變
+        sheet = self.get_spreadsheet()
+        getter = getattr(sheet, 'get_lastUpdateTime', None)
+        if callable(getter): return str(getter())
+        # 舊版 gspread 沒有 get_lastUpdateTime，直接打 Drive files.get (6.x 的 request 在 http_client 上)
+        client = self.get_client()
+        http = getattr(client, 'http_client', client)
+        resp = http.request('get', f"{DRIVE_FILES_API_V3_URL}/{sheet.id}", params={'fields': 'modifiedTime', 'supportsAllDrives': True})
+        return resp.json().get('modifiedTime')
+
+    def write_lock(self, worksheet_name):
+        """同一個分頁的寫入 (含背景同步寫回快照) 依序進行；可重入"""
+        with self._lock:
+            return self._write_locks.setdefault(worksheet_name, threading.RLock())
+
+    def get_snapshot(self, worksheet_name):
+        with self._lock:
+            return self._snapshots.get(worksheet_name)
+
+    def get_snapshot_revision(self, worksheet_name):
+        with self._lock:
+            return self._snapshot_rev.get(worksheet_name)
+
+    def set_snapshot(self, worksheet_name, grid, revision=None):
+        with self._lock:
+            self._snapshots[worksheet_name] = [[_gsheet_cell_str(v) for v in row] for row in grid]
+            self._snapshot_rev[worksheet_name] = revision
+            self._key_index = {k: v for k, v in self._key_index.items() if k[0] != worksheet_name}
+
+    def drop_snapshot(self, worksheet_name):
+        with self._lock:
+            self._snapshots.pop(worksheet_name, None)
+            self._snapshot_rev.pop(worksheet_name, None)
+            self._key_index = {k: v for k, v in self._key_index.items() if k[0] != worksheet_name}
+
+    def get_key_index(self, worksheet_name, key_col, revision=None):
+        """
+        回傳 (header, keys)，keys[i] 對應試算表第 i+2 列的主鍵 (已正規化)。
+        優先由同版本的 snapshot 推得；否則只下載標題列與主鍵那一欄，不抓整張表。
+        """
+        with self._lock:
+            cached = self._key_index.get((worksheet_name, key_col))
+            if cached is not None and cached[2] == revision:
+                return list(cached[0]), list(cached[1])
+            snapshot = self._snapshots.get(worksheet_name)
+            if self._snapshot_rev.get(worksheet_name) != revision:
+                snapshot = None
+        if snapshot:
+            header = list(snapshot[0])
+            col_idx = header.index(key_col) if key_col in header else None
+            raw_keys = [row[col_idx] if col_idx is not None and col_idx < len(row) else '' for row in snapshot[1:]]
+        else:
+            ws = self.get_worksheet(worksheet_name)
+            header = ws.row_values(1)
+            raw_keys = ws.col_values(header.index(key_col) + 1)[1:] if key_col in header else []
+        keys = [_normalize_date_key(k) for k in raw_keys]
+        with self._lock:
+            self._key_index[(worksheet_name, key_col)] = (header, keys, revision)
+        return header, keys
+
+    def set_key_index(self, worksheet_name, key_col, header, keys, revision=None):
+        with self._lock:
+            self._key_index[(worksheet_name, key_col)] = (list(header), list(keys), revision)
+
+    def invalidate(self):
+        # 發生連線/授權錯誤時丟掉所有 handle，下次呼叫重新建立
+        with self._lock:
+            self._client = None
+            self._spreadsheet = None
+            self._worksheets = {}
+            self._snapshots = {}
+            self._snapshot_rev = {}
+            self._key_index = {}
+
+@st.cache_resource
+def get_gsheet_manager():
+    return GSheetConnectionManager()
+
 def get_gsheet_connection():
-    # 定義需要的權限範圍
-    scope = ['https://spreadsheets.google.com/feeds', 'https://www.googleapis.com/auth/drive']
+    return get_gsheet_manager().get_client()
+
+# --- 格子 (list of lists) 轉換工具 ---
+def _gsheet_cell_str(v):
+    # 統一成 Google Sheets 顯示的字串，24 與 24.0 視為相同，避免誤判為變動
+    if v is None: return ""
+    if isinstance(v, float):
+        if pd.isna(v): return ""
+        if v.is_integer(): return str(int(v))
+    return str(v)
+
+def _normalize_date_key(v):
+    # 試算表裡的日期可能是 2025-12-04 / 2025/12/04 等格式，統一成 YYYY-MM-DD 才能比對
+    raw = _gsheet_cell_str(v).strip()
+    dt = pd.to_datetime(raw, errors='coerce')
+    return raw if pd.isna(dt) else dt.strftime('%Y-%m-%d')
+
+# --- 分頁欄位型別宣告 (typed ingestion)：整欄一次轉型，不再逐列建立 dict ---
+INDEX_HISTORY_SCHEMA = {"日期": "datetime", "收": "float", "20MA": "float", "風度": "category", "乖離率": "str"}
+SHEET_SCHEMAS = {
+    "Daily_Main": {
+        "date": "date_str", "wind": "category",
+        "part_time_count": "int32", "worker_strong_count": "int32", "worker_trend_count": "int32",
+        "worker_strong_list": "str", "worker_trend_list": "str", "boss_pullback_list": "str",
+        "boss_bargain_list": "str", "top_revenue_list": "str", "last_updated": "str", "manual_turnover": "str"
+    },
+    "TAIEX": INDEX_HISTORY_SCHEMA,
+    "TPEx": INDEX_HISTORY_SCHEMA,
+}
+
+def _coerce_column(col, kind):
+    # col 為試算表的原始字串欄位
+    if kind == "str": return col
+    if kind == "int32": return pd.to_numeric(col, errors='coerce').fillna(0).astype('int32')
+    if kind == "category": return col.astype('category')
+    if kind == "date_str": return pd.to_datetime(col, errors='coerce').dt.strftime('%Y-%m-%d')
+    if kind == "datetime": return pd.to_datetime(col, errors='coerce')
+    # "float" 與未宣告的欄位：整欄都是數字才轉型；混有文字 (例如千分位) 就保留原字串，寫回時才不會遺失資料
+    num = pd.to_numeric(col, errors='coerce')
+    n_filled = int((col != '').sum())
+    if n_filled and int(num.notna().sum()) == n_filled: return num
+    return col
+
+def _grid_to_typed_df(worksheet_name, grid):
+    # 第一列當標題，其餘依 SHEET_SCHEMAS 一次轉型
+    if len(grid) < 2: return pd.DataFrame()
+    df = pd.DataFrame(grid[1:], columns=grid[0])
+    schema = SHEET_SCHEMAS.get(worksheet_name, {})
+    for col in df.columns:
+        df[col] = _coerce_column(df[col], schema.get(col, "auto"))
+    return df
+
+def _df_to_grid(df):
+    # 處理 DataFrame: 日期轉字串，NaN 轉空字串；gspread 需要 list of lists 格式，且包含標題
+    df_save = df.copy()
+    # category 欄位不能直接 fillna('')，先轉回一般字串
+    for col in df_save.select_dtypes(include='category').columns:
+        df_save[col] = df_save[col].astype(object)
+    if '日期' in df_save.columns:
+        df_save['日期'] = df_save['日期'].dt.strftime('%Y-%m-%d')
+    df_save = df_save.fillna('')
+    return [df_save.columns.values.tolist()] + df_save.values.tolist()
+
+def _diff_grid_ranges(old_grid, new_grid):
+    """
+    逐列比對新舊格子，只回傳有變動的區塊 (batch_update 格式)。
+    新增列 = 舊格子沒有的列；刪除列 = 新格子沒有的列 (以空字串覆蓋)。
+    連續且欄位範圍相同的列會合併成一個 range。
+    """
+    n_cols = max([len(r) for r in old_grid] + [len(r) for r in new_grid] + [1])
+    ranges = []
+    last = None  # (起始列, 結束列, 起始欄, 結束欄, values)
+    for i in range(max(len(old_grid), len(new_grid))):
+        old_row = old_grid[i] if i < len(old_grid) else []
+        new_row = list(new_grid[i]) if i < len(new_grid) else []
+        new_row += [''] * (n_cols - len(new_row))
+        old_cells = list(old_row) + [''] * (n_cols - len(old_row))
+        changed = [j for j in range(n_cols) if _gsheet_cell_str(new_row[j]) != old_cells[j]]
+        if not changed: continue
+        c0, c1 = changed[0], changed[-1]
+        values = new_row[c0:c1 + 1]
+        if last and last[1] == i - 1 and last[2] == c0 and last[3] == c1:
+            last[1] = i
+            last[4].append(values)
+        else:
+            last = [i, i, c0, c1, [values]]
+            ranges.append(last)
+    return [
+        {'range': f"{rowcol_to_a1(r0 + 1, c0 + 1)}:{rowcol_to_a1(r1 + 1, c1 + 1)}", 'values': vals}
+        for r0, r1, c0, c1, vals in ranges
+    ]
+
+# --- 本地試算表鏡像 (SQLite)：同主機的多個 replica 共用一份，只在試算表真的變動時才同步 ---
+SHEET_MIRROR_FILE = 'gsheet_mirror.sqlite'
+SHEET_MIRROR_SYNC_SEC = 60 # 背景檢查試算表版本的間隔 (秒)
+MIRRORED_SHEETS = ["Daily_Main", "TAIEX", "TPEx"]
+
+class SQLiteStore:
+    """本地 SQLite 檔案的共用基底 (跨 Session / thread 共用，多個 replica 可共用同一個檔案)"""
+    def __init__(self, path):
+        self.path = path
+
+    def _execute(self, sql, params=()):
+        return self._execute_many([(sql, params)])
+
+    def _execute_many(self, statements):
+        # 每次開新連線：sqlite 連線不能跨 thread 共用；多個語句在同一個交易內完成
+        # params 為 list 時視為多筆資料 (executemany)
+        conn = sqlite3.connect(self.path, timeout=10)
+        try:
+            with conn:
+                rows = []
+                for sql, params in statements:
+                    if isinstance(params, list): conn.executemany(sql, params)
+                    else: rows = conn.execute(sql, params).fetchall()
+                return rows
+        finally:
+            conn.close()
+
+class LocalSheetMirror(SQLiteStore):
+    """
+    每個分頁存一份原始格子 (JSON) 並標記來源版本 (revision)。
+    meta 表記錄最後一次檢查版本的時間，讓多個 replica 不會重複打 API。
+    versions 表是每個分頁單調遞增的版本號：分頁內容一有變動 (寫入/同步/失效) 就 +1，
+    讀取快取以 (分頁, 版本號) 為 key，因此只有變動的分頁需要重新讀。
+    """
+    def __init__(self, path=SHEET_MIRROR_FILE):
+        super().__init__(path)
+        self._execute("CREATE TABLE IF NOT EXISTS sheets (name TEXT PRIMARY KEY, revision TEXT, synced_at REAL, grid TEXT)")
+        self._execute("CREATE TABLE IF NOT EXISTS meta (key TEXT PRIMARY KEY, value TEXT)")
+        self._execute("CREATE TABLE IF NOT EXISTS versions (name TEXT PRIMARY KEY, version INTEGER NOT NULL)")
+
+    _BUMP_VERSION_SQL = "INSERT INTO versions VALUES (?, 1) ON CONFLICT(name) DO UPDATE SET version = version + 1"
+
+    def read(self, name):
+        rows = self._execute("SELECT grid, revision FROM sheets WHERE name = ?", (name,))
+        if not rows: return None, None
+        return json.loads(rows[0][0]), rows[0][1]
+
+    def revision_of(self, name):
+        rows = self._execute("SELECT revision FROM sheets WHERE name = ?", (name,))
+        return rows[0][0] if rows else None
+
+    def names(self):
+        return [r[0] for r in self._execute("SELECT name FROM sheets")]
+
+    def write(self, name, grid, revision):
+        grid_str = [[_gsheet_cell_str(v) for v in row] for row in grid]
+        self._execute_many([
+            ("INSERT OR REPLACE INTO sheets VALUES (?, ?, ?, ?)", (name, revision, time.time(), json.dumps(grid_str, ensure_ascii=False))),
+            (self._BUMP_VERSION_SQL, (name,)),
+        ])
+
+    def drop(self, name):
+        self._execute_many([
+            ("DELETE FROM sheets WHERE name = ?", (name,)),
+            (self._BUMP_VERSION_SQL, (name,)),
+        ])
+
+    def versions_of(self, names):
+        names = list(names)
+        rows = self._execute(f"SELECT name, version FROM versions WHERE name IN ({','.join('?' * len(names))})", tuple(names))
+        found = dict(rows)
+        return tuple(found.get(name, 0) for name in names)
+
+    def get_meta(self, key):
+        rows = self._execute("SELECT value FROM meta WHERE key = ?", (key,))
+        return rows[0][0] if rows else None
+
+    def set_meta(self, key, value):
+        self._execute("INSERT OR REPLACE INTO meta VALUES (?, ?)", (key, value))
+
+    def claim_sync(self, interval):
+        # 原子地「檢查 + 登記」：同一個 interval 內只有一個 replica 會去問 Google
+        conn = sqlite3.connect(self.path, timeout=10, isolation_level=None)
+        try:
+            conn.execute("BEGIN IMMEDIATE")
+            row = conn.execute("SELECT value FROM meta WHERE key = 'checked_at'").fetchone()
+            now = time.time()
+            if row and now - float(row[0]) < interval:
+                conn.execute("ROLLBACK")
+                return False
+            conn.execute("INSERT OR REPLACE INTO meta VALUES ('checked_at', ?)", (str(now),))
+            conn.execute("COMMIT")
+            return True
+        finally:
+            conn.close()
+
+@st.cache_resource
+def get_sheet_mirror():
+    return LocalSheetMirror()
+
+def sync_sheet_mirror(mirror, manager, force=False):
+    """比對試算表版本，只有版本不同的分頁才重新下載 (寫入鏡像時該分頁版本號 +1)。回傳有更新的分頁"""
+    if not force and not mirror.claim_sync(SHEET_MIRROR_SYNC_SEC):
+        return []
+    revision = manager.get_revision()
+    stale = [name for name in sorted(set(MIRRORED_SHEETS) | set(mirror.names()))
+             if not revision or mirror.revision_of(name) != revision]
+    before = dict(zip(stale, mirror.versions_of(stale))) if stale else {}
+    grids = fetch_sheet_grids(stale) if stale else {}
+    updated = []
+    for name, grid in grids.items():
+        if grid is None: continue
+        with manager.write_lock(name):
+            # 下載期間本機剛寫入過這個分頁：手上的內容比剛抓到的新，不覆蓋
+            if mirror.versions_of([name])[0] != before[name]: continue
+            mirror.write(name, grid, revision)
+            manager.set_snapshot(name, grid, revision)
+        updated.append(name)
+    mirror.set_meta('revision', revision)
+    return updated
+
+def _sheet_mirror_sync_loop(mirror, manager):
+    while True:
+        try:
+            sync_sheet_mirror(mirror, manager)
+        except Exception as e:
+            print(f"Sheet mirror sync error: {e}")
+            manager.invalidate()
+        time.sleep(SHEET_MIRROR_SYNC_SEC)
+
+@st.cache_resource
+def start_sheet_mirror_sync():
+    # 每個 Server 只啟動一次的背景同步執行緒
+    t = threading.Thread(
+        target=_sheet_mirror_sync_loop,
+        args=(get_sheet_mirror(), get_gsheet_manager()),
+        name="sheet-mirror-sync", daemon=True
+    )
+    t.start()
+    return t
+
+def fetch_sheet_grids(worksheet_names):
+    """
+    用一次 values_batch_get 抓回多個分頁的原始格子 (與 get_all_values 相同格式)。
+    找不到的分頁回傳 None；只查一個分頁時則直接丟出 WorksheetNotFound。
+    """
+    worksheet_names = list(worksheet_names)
+    sheet = get_gsheet_manager().get_spreadsheet()
+    ranges = ["'{}'".format(name.replace("'", "''")) for name in worksheet_names]
+    try:
+        resp = sheet.values_batch_get(ranges)
+    except gspread.exceptions.APIError as e:
+        if "Unable to parse range" not in str(e): raise
+        if len(worksheet_names) == 1: raise gspread.exceptions.WorksheetNotFound(worksheet_names[0])
+        # 其中有分頁不存在：改成逐一抓，讓其他分頁照常顯示
+        grids = {}
+        for name in worksheet_names:
+            try: grids.update(fetch_sheet_grids([name]))
+            except gspread.exceptions.WorksheetNotFound: grids[name] = None
+        return grids
+    grids = {}
+    for name, value_range in zip(worksheet_names, resp.get('valueRanges', [])):
+        rows = value_range.get('values', [])
+        width = max((len(r) for r in rows), default=0)
+        grids[name] = [r + [''] * (width - len(r)) for r in rows]
+    return grids
+
+def read_sheet_grids(worksheet_names):
+    """
+    讀取多個分頁原始格子：優先讀本地鏡像 (毫秒級)。
+    只要有分頁不在鏡像、或版本不一致，就用一次 batch 請求整組重抓，確保是同一個時間點的資料。
+    """
+    manager = get_gsheet_manager()
+    mirror = get_sheet_mirror()
+    start_sheet_mirror_sync()
+    cached = {name: mirror.read(name) for name in worksheet_names}
+    revisions = {rev for _, rev in cached.values()}
+    if all(grid is not None for grid, _ in cached.values()) and len(revisions) == 1:
+        grids = {name: grid for name, (grid, _) in cached.items()}
+        revision = revisions.pop()
+    else:
+        revision = mirror.get_meta('revision')
+        grids = fetch_sheet_grids(worksheet_names)
+        for name, grid in grids.items():
+            if grid is not None: mirror.write(name, grid, revision)
+    for name, grid in grids.items():
+        if grid is not None: manager.set_snapshot(name, grid, revision)
+    return grids
+
+def read_sheet_grid(worksheet_name):
+    return read_sheet_grids([worksheet_name])[worksheet_name]
+
+def _get_fresh_snapshot(worksheet_name):
+    # 寫入前確認 snapshot 與試算表同版本；不同 (例如別的 replica 剛寫過) 才重新下載
+    manager = get_gsheet_manager()
+    revision = manager.get_revision()
+    if manager.get_snapshot(worksheet_name) is None or manager.get_snapshot_revision(worksheet_name) != revision:
+        grid = fetch_sheet_grids([worksheet_name])[worksheet_name]
+        get_sheet_mirror().write(worksheet_name, grid, revision)
+        manager.set_snapshot(worksheet_name, grid, revision)
+    return manager.get_snapshot(worksheet_name)
+
+def _remember_written_grid(worksheet_name, grid):
+    # 寫入成功後，snapshot 與鏡像直接換成剛寫進去的內容 (不用再讀一次)
+    manager = get_gsheet_manager()
+    revision = manager.get_revision()
+    manager.set_snapshot(worksheet_name, grid, revision)
+    get_sheet_mirror().write(worksheet_name, grid, revision)
+
+# --- 原始格子 -> DataFrame (讀取後的共用處理) ---
+# 讀取函式可能在 SWR 背景 thread 執行 (沒有 ScriptRunContext，st.error 會消失)，
+# 所以只回傳 (df, 問題)，問題 = ("error"/"warning", 訊息) 或 None，由畫面端 _show_sheet_issues 顯示
+def _show_sheet_issues(issues):
+    for level, msg in issues:
+        if level == "error": st.error(msg)
+        else: st.warning(msg)
+
+def _spreadsheet_not_found_issue():
+    return ("error", f"❌ 找不到試算表！請確認 Secrets 裡的 sheet_name = '{st.secrets.get('sheet_name')}' 是否跟 Google Drive 檔名完全一致。")
+
+def _grid_to_sheet_df(worksheet_name, grid):
+    if grid is None:
+        return pd.DataFrame(), ("error", f"❌ 找不到分頁 '{worksheet_name}'！請確認 Google Sheet 下方的分頁名稱是否完全一樣 (注意大小寫)。")
+    df = _grid_to_typed_df(worksheet_name, grid)
+    
+    # 如果抓下來是空的，顯示警告
+    if df.empty:
+        return pd.DataFrame(), ("warning", f"⚠️ 成功連上 {worksheet_name}，但 Google 回傳資料為空。請檢查該分頁第一列是否有欄位名稱。")
     
-    # 從 Streamlit Secrets 讀取憑證
-    # 注意：Secrets 裡面的 key 必須對應你的設定，這裡假設是 [gcp_service_account]
-    creds = ServiceAccountCredentials.from_json_keyfile_dict(st.secrets["gcp_service_account"], scope)
-    client = gspread.authorize(creds)
-    return client
+    # 有宣告型別的日期欄已在轉型時解析，這裡只排序
+    schema = SHEET_SCHEMAS.get(worksheet_name, {})
+    if 'date' in df.columns:
+        if schema.get('date') != "date_str":
+            df['date'] = pd.to_datetime(df['date'], errors='coerce').dt.strftime('%Y-%m-%d')
+        df = df.sort_values('date', ascending=False)
+    elif '日期' in df.columns:
+        if schema.get('日期') != "datetime":
+            df['日期'] = pd.to_datetime(df['日期'], errors='coerce')
+        df = df.dropna(subset=['日期']).sort_values('日期')
+        
+    return df, None
 
 # --- 通用讀取函式 (取代 load_history_data) ---
-@st.cache_data(ttl=60) # 設定 60 秒快取，避免頻繁呼叫 API
+# 快取 key 帶分頁版本號：寫入某個分頁只會讓該分頁的快取失效，其他分頁照常命中
 def load_data_from_gsheet(worksheet_name):
+    version, = get_sheet_mirror().versions_of([worksheet_name])
+    df, issue = _load_sheet_versioned(worksheet_name, version)
+    if issue: _show_sheet_issues([issue])
+    return df
+
+@swr_cache(ttl=60, max_entries=64, is_valid=lambda v: not v[0].empty) # 60 秒後在背景重新讀本地鏡像，避免頻繁呼叫 API
+def _load_sheet_versioned(worksheet_name, version):
     try:
-        # 1. 測試連線憑證
-        client = get_gsheet_connection()
-        
-        # 2. 測試開啟試算表
-        # 顯示正在嘗試開啟的名稱，方便除錯
-        target_sheet = st.secrets["sheet_name"]
-        sheet = client.open(target_sheet)
-        
-        # 3. 測試開啟分頁
-        ws = sheet.worksheet(worksheet_name)
-        
-        # 4. 讀取資料
-        data = ws.get_all_records()
-        
-        # 5. 如果抓下來是空的，顯示警告
-        if not data:
-            st.warning(f"⚠️ 成功連上 {worksheet_name}，但 Google 回傳資料為空。請檢查該分頁第一列是否有欄位名稱。")
-            return pd.DataFrame()
-            
-        df = pd.DataFrame(data)
-        
-        # 資料處理 (維持原樣)
-        if 'date' in df.columns:
-            df['date'] = pd.to_datetime(df['date'], errors='coerce').dt.strftime('%Y-%m-%d')
-            df = df.sort_values('date', ascending=False)
-        elif '日期' in df.columns:
-            df['日期'] = pd.to_datetime(df['日期'], errors='coerce')
-            df = df.dropna(subset=['日期']).sort_values('日期')
-            
-        return df
+        # 讀取資料：本地鏡像優先，同時保留原始格子作為差異寫入的比對基準
+        grid = read_sheet_grid(worksheet_name)
+        return _grid_to_sheet_df(worksheet_name, grid)
         
     except gspread.exceptions.SpreadsheetNotFound:
-        st.error(f"❌ 找不到試算表！請確認 Secrets 裡的 sheet_name = '{st.secrets.get('sheet_name')}' 是否跟 Google Drive 檔名完全一致。")
-        return pd.DataFrame()
+        return pd.DataFrame(), _spreadsheet_not_found_issue()
     except gspread.exceptions.WorksheetNotFound:
-        st.error(f"❌ 找不到分頁 '{worksheet_name}'！請確認 Google Sheet 下方的分頁名稱是否完全一樣 (注意大小寫)。")
-        return pd.DataFrame()
+        return _grid_to_sheet_df(worksheet_name, None)
     except Exception as e:
-        st.error(f"❌ 發生未預期的錯誤 ({worksheet_name}): {e}")
-        return pd.DataFrame()
+        get_gsheet_manager().invalidate()
+        return pd.DataFrame(), ("error", f"❌ 發生未預期的錯誤 ({worksheet_name}): {e}")
 
-# --- 通用寫入函式 (取代 save_batch_data / to_csv) ---
-def save_data_to_gsheet(df, worksheet_name):
+# --- 儀表板一次讀齊所有分頁 (單一快照、單次 round trip) ---
+DASHBOARD_SHEETS = ("Daily_Main", "TAIEX", "TPEx")
+
+def load_dashboard_sheets():
+    sheets, issues = _load_dashboard_sheets_versioned(get_sheet_mirror().versions_of(DASHBOARD_SHEETS))
+    _show_sheet_issues(issues)
+    return sheets
+
+@swr_cache(ttl=60, max_entries=16, is_valid=lambda v: _swr_is_valid(v[0]))
+def _load_dashboard_sheets_versioned(versions):
+    """
+    一次 values_batch_get 取回儀表板需要的所有分頁，並以同一筆快取保存，
+    避免三個分頁各自過期、各自打 API，也避免資料來自不同時間點。
+    回傳 ({分頁: df}, [問題...])。
+    """
     try:
-        client = get_gsheet_connection()
-        sheet = client.open(st.secrets["sheet_name"])
-        ws = sheet.worksheet(worksheet_name)
-        
-        # 1. 處理 DataFrame: 日期轉字串，NaN 轉空字串
-        df_save = df.copy()
-        if '日期' in df_save.columns:
-            df_save['日期'] = df_save['日期'].dt.strftime('%Y-%m-%d')
-        df_save = df_save.fillna('')
-        
-        # 2. 清空工作表並寫入新資料
-        ws.clear()
-        # gspread 需要 list of lists 格式，且包含標題
-        data_to_upload = [df_save.columns.values.tolist()] + df_save.values.tolist()
-        ws.update(data_to_upload)
-        
-        # 清除讀取快取，確保下次讀到最新的
-        load_data_from_gsheet.clear()
-        return True, "✅ 資料已同步至 Google Sheets！"
+        grids = read_sheet_grids(DASHBOARD_SHEETS)
+        results = {name: _grid_to_sheet_df(name, grids.get(name)) for name in DASHBOARD_SHEETS}
+        return {name: df for name, (df, _) in results.items()}, [issue for _, issue in results.values() if issue]
+    except gspread.exceptions.SpreadsheetNotFound:
+        issue = _spreadsheet_not_found_issue()
     except Exception as e:
-        return False, f"❌ 寫入失敗: {e}"
+        get_gsheet_manager().invalidate()
+        issue = ("error", f"❌ 發生未預期的錯誤 (儀表板資料): {e}")
+    return {name: pd.DataFrame() for name in DASHBOARD_SHEETS}, [issue]
+
+def invalidate_sheet(worksheet_name):
+    # 丟掉該分頁的本地鏡像 (版本號 +1)，下次讀取會重新向 Google 下載
+    get_gsheet_manager().drop_snapshot(worksheet_name)
+    get_sheet_mirror().drop(worksheet_name)
+
+# --- 通用寫入函式 (取代 save_batch_data / to_csv) ---
+# mode="diff": 與上次讀取的 snapshot 比對，只送出變動的儲存格 / 新增列 / 刪除列 (一次 batch_update)
+# mode="full": 整張覆寫 (先寫入再清掉多出來的舊列，不會有讀到空白分頁的空窗期)
+def save_data_to_gsheet(df, worksheet_name, mode="diff"):
+    # 同一個分頁的寫入依序進行，避免與 upsert / 背景同步交錯
+    with get_gsheet_manager().write_lock(worksheet_name):
+        try:
+            manager = get_gsheet_manager()
+            ws = manager.get_worksheet(worksheet_name)
+
+            # 1. 處理 DataFrame: 日期轉字串，NaN 轉空字串
+            data_to_upload = _df_to_grid(df)
+            n_rows = len(data_to_upload)
+            n_cols = max(len(r) for r in data_to_upload)
+
+            # 分頁格數不夠時先擴充 (update 不會自動長出新列)
+            if n_rows > ws.row_count: ws.add_rows(n_rows - ws.row_count)
+            if n_cols > ws.col_count: ws.add_cols(n_cols - ws.col_count)
+
+            # 2. 寫入資料
+            snapshot = _get_fresh_snapshot(worksheet_name) if mode == "diff" else None
+            header = [_gsheet_cell_str(v) for v in data_to_upload[0]]
+            if mode == "diff" and snapshot and snapshot[0] == header:
+                changes = _diff_grid_ranges(snapshot, data_to_upload)
+                if changes:
+                    ws.batch_update(changes)
+            else:
+                ws.update(data_to_upload)
+                # 清掉新資料範圍以外的舊內容 (列變少或欄變少時)
+                stale_ranges = []
+                if ws.row_count > n_rows:
+                    stale_ranges.append(f"{rowcol_to_a1(n_rows + 1, 1)}:{rowcol_to_a1(ws.row_count, ws.col_count)}")
+                if ws.col_count > n_cols:
+                    stale_ranges.append(f"{rowcol_to_a1(1, n_cols + 1)}:{rowcol_to_a1(n_rows, ws.col_count)}")
+                if stale_ranges:
+                    ws.batch_clear(stale_ranges)
+            # 鏡像寫入時版本號 +1，只有這個分頁的讀取快取會失效
+            _remember_written_grid(worksheet_name, data_to_upload)
+            return True, "✅ 資料已同步至 Google Sheets！"
+        except Exception as e:
+            get_gsheet_manager().invalidate()
+            return False, f"❌ 寫入失敗: {e}"
 		
+# --- 以日期為主鍵的 upsert (不重新下載整張表) ---
+def upsert_rows_by_key(df_new, worksheet_name, key_col='date'):
+    """
+    將 df_new 依 key_col 寫入分頁：已存在的日期直接覆寫該列，
+    新日期依「新到舊」的排序插入對應位置。只用到快取的 日期 -> 列號 索引。
+    """
+    # 列號索引、batch_update、insert_rows 整段持有分頁寫入鎖：兩個同時的寫入不會用同一份索引互相錯位
+    with get_gsheet_manager().write_lock(worksheet_name):
+        try:
+            manager = get_gsheet_manager()
+            ws = manager.get_worksheet(worksheet_name)
+            revision = manager.get_revision()
+            header, keys = manager.get_key_index(worksheet_name, key_col, revision)
+            if not header or key_col not in header:
+                # 空白分頁 (連標題都沒有)：直接整張寫入
+                return save_data_to_gsheet(df_new, worksheet_name, mode="full")
+
+            new_grid = _df_to_grid(df_new)
+            new_header = [str(c) for c in new_grid[0]]
+            batch = []
+
+            # 新資料有舊分頁沒有的欄位：補在標題列最後面
+            extra_cols = [c for c in new_header if c not in header]
+            if extra_cols:
+                if len(header) + len(extra_cols) > ws.col_count:
+                    ws.add_cols(len(header) + len(extra_cols) - ws.col_count)
+                batch.append({'range': f"{rowcol_to_a1(1, len(header) + 1)}:{rowcol_to_a1(1, len(header) + len(extra_cols))}", 'values': [extra_cols]})
+                header = header + extra_cols
+
+            row_map = {k: i + 2 for i, k in enumerate(keys)}
+            last_cell_col = len(header)
+            inserts = {}  # 插入位置 (keys 的 index) -> [(key, row_values)]
+            for rec in new_grid[1:]:
+                rec_dict = dict(zip(new_header, rec))
+                key = _normalize_date_key(rec_dict.get(key_col, ''))
+                rec_dict[key_col] = key
+                row_values = [rec_dict.get(h, '') for h in header]
+                if key in row_map:
+                    r = row_map[key]
+                    batch.append({'range': f"{rowcol_to_a1(r, 1)}:{rowcol_to_a1(r, last_cell_col)}", 'values': [row_values]})
+                else:
+                    # 找第一個比新日期舊的列，插在它前面 (維持新到舊)
+                    pos = next((i for i, k in enumerate(keys) if k < key), len(keys))
+                    inserts.setdefault(pos, []).append((key, row_values))
+
+            # 1. 覆寫既有日期 (一次 batch_update)
+            if batch:
+                ws.batch_update(batch)
+
+            # 2. 由下往上插入新日期，才不會影響上方尚未插入的列號
+            # 在複本上修改，不動到 manager 裡共用的 snapshot
+            snapshot = manager.get_snapshot(worksheet_name) if manager.get_snapshot_revision(worksheet_name) == revision else None
+            snapshot = [list(row) for row in snapshot] if snapshot else None
+            for pos in sorted(inserts, reverse=True):
+                block = sorted(inserts[pos], key=lambda x: x[0], reverse=True)
+                ws.insert_rows([row for _, row in block], row=pos + 2)
+                keys[pos:pos] = [k for k, _ in block]
+                if snapshot:
+                    snapshot[pos + 1:pos + 1] = [[_gsheet_cell_str(v) for v in row] for _, row in block]
+
+            # 3. 同步本地的 snapshot 與索引，下次寫入不必再讀
+            if snapshot:
+                snapshot[0] = [_gsheet_cell_str(v) for v in header]
+                row_of = {k: i + 1 for i, k in enumerate(keys)}
+                for rec in new_grid[1:]:
+                    rec_dict = dict(zip(new_header, rec))
+                    key = _normalize_date_key(rec_dict.get(key_col, ''))
+                    rec_dict[key_col] = key
+                    snapshot[row_of[key]] = [_gsheet_cell_str(rec_dict.get(h, '')) for h in header]
+                _remember_written_grid(worksheet_name, snapshot)
+            else:
+                # 手上沒有完整內容：讓鏡像失效，下次讀取再整張同步
+                manager.drop_snapshot(worksheet_name)
+                get_sheet_mirror().drop(worksheet_name)
+            manager.set_key_index(worksheet_name, key_col, header, keys, manager.get_snapshot_revision(worksheet_name) or manager.get_revision())
+            return True, f"✅ 已寫入 {len(new_grid) - 1} 筆資料至 Google Sheets！"
+        except Exception as e:
+            get_gsheet_manager().invalidate()
+            return False, f"❌ 寫入失敗: {e}"
+
 # 修正 Pydantic 錯誤
 try:
     from typing_extensions import TypedDict
@@ -349,6 +1414,302 @@ for code, (name, sector) in MASTER_STOCK_DB.items():
     NAME_TO_SECTOR[name] = sector
     NAME_TO_CODE[name] = code
 
+# --- 交易所後綴解析 (代號 → .TW 上市 / .TWO 上櫃) ---
+# 已知的上櫃代號作為種子，其餘預設上市；實際抓到資料後記住並存檔，
+# 之後下載只請求存在的那一個 ticker，不必每檔都同時抓 .TW 與 .TWO
+# (MASTER_STOCK_DB 的「上櫃」分區有標錯的，例如南電、泰金寶在上市，穩懋、世界、力旺在上櫃，不能直接照抄)
+EXCHANGE_MAP_FILE = 'exchange_map.json'
+OTC_SEED_CODES = {
+    "8299", "8069", "6488", "3293", "3131", "4966", "5274", "6274", "3374", "6147", "5483", "6223",
+    "3081", "4979", "5289", "4760", "6683", "6187", "3583", "6138", "3680", "5425", "3260", "4768",
+    "5314", "3162", "8358", "3163", "4908", "3363", "6279", "3693", "3558", "6180", "6182", "8086",
+    "5284", "6895", "8054", "6739", "4971",
+    "3105", "5347", "3529", "6290", "3324", "3551", "3402", "4772", "3581", "4541", "3526", "6217",
+    "6643", "6163", "5309", "6664", "8155", "3217", "8042", "3357", "6667", "6691",
+}
+
+class ExchangeResolver:
+    """
+    跨 Session 共用的 代號 → 交易所後綴 對照表 (thread-safe)。
+    - 確認過 (實際抓到資料) 的代號存到 EXCHANGE_MAP_FILE；
+    - 種子只是猜測：猜的後綴抓不到資料時，同一次下載改試另一個後綴 (見 fetch_with_exchange_fallback)，
+      並把種子退回「未知」，之後以實際抓到的為準。
+    """
+    def __init__(self, path=EXCHANGE_MAP_FILE):
+        self.path = path
+        self._lock = threading.Lock()
+        self._dirty = False
+        self._seeds = {code: ('.TWO' if code in OTC_SEED_CODES else '.TW') for code in MASTER_STOCK_DB}
+        self._confirmed = {}
+        if os.path.exists(path):
+            try:
+                with open(path, 'r', encoding='utf-8') as f:
+                    self._confirmed = {str(k): v for k, v in json.load(f).items() if v in ('.TW', '.TWO')}
+            except Exception as e:
+                print(f"Load Exchange Map Error: {e}")
+
+    def candidates(self, codes):
+        """回傳 {代號: [要下載的 ticker...]}，已知的只給一個，未知的兩個都給"""
+        with self._lock:
+            result = {}
+            for code in codes:
+                suffix = self._confirmed.get(code) or self._seeds.get(code)
+                result[code] = [f"{code}{suffix}"] if suffix else [f"{code}.TW", f"{code}.TWO"]
+            return result
+
+    def alternate(self, code, tried):
+        """猜測的後綴沒資料時要補試的 ticker；已確認交易所 (沒資料代表當天沒成交) 或兩個都試過時回傳 None"""
+        with self._lock:
+            if code in self._confirmed: return None
+        for ticker in (f"{code}.TW", f"{code}.TWO"):
+            if ticker not in tried: return ticker
+        return None
+
+    def observe(self, ticker, has_data):
+        """記錄某個 ticker 有沒有抓到資料"""
+        code, _, exchange = ticker.partition('.')
+        suffix = f".{exchange}"
+        with self._lock:
+            if has_data:
+                if self._confirmed.get(code) != suffix:
+                    self._confirmed[code] = suffix
+                    self._dirty = True
+            elif code not in self._confirmed and self._seeds.get(code) == suffix:
+                # 種子猜錯 (或當天沒交易)：改回未知，下次兩個後綴都試
+                del self._seeds[code]
+
+    def learn_markets(self, codes, market):
+        """從排行榜的「市場」欄位 (上市/上櫃) 直接學習"""
+        if market not in ("上市", "上櫃"): return
+        suffix = '.TWO' if market == '上櫃' else '.TW'
+        with self._lock:
+            for code in codes:
+                if self._confirmed.get(code) != suffix:
+                    self._confirmed[code] = suffix
+                    self._dirty = True
+
+    def flush(self):
+        with self._lock:
+            if not self._dirty: return
+            data = dict(self._confirmed)
+            self._dirty = False
+        try:
+            tmp_path = f"{self.path}.tmp"
+            with open(tmp_path, 'w', encoding='utf-8') as f:
+                json.dump(data, f, ensure_ascii=False, indent=0, sort_keys=True)
+            os.replace(tmp_path, self.path)
+        except Exception as e:
+            print(f"Save Exchange Map Error: {e}")
+
+@st.cache_resource
+def get_exchange_resolver():
+    return ExchangeResolver()
+
+def fetch_with_exchange_fallback(resolver, candidates, fetch):
+    """
+    candidates: {代號: [ticker...]}；fetch(tickers) 回傳 {ticker: DataFrame}。
+    猜測的後綴沒抓到資料的代號，在同一次呼叫內改抓另一個後綴，結果一併回報給 resolver。
+    回傳 (bars, candidates)，candidates 會加上補抓的 ticker。
+    """
+    bars = dict(fetch([t for ts in candidates.values() for t in ts]))
+    has_data = lambda t: t in bars and not bars[t].empty
+    alternates = {}
+    for code, tickers in candidates.items():
+        if any(has_data(t) for t in tickers): continue
+        alt = resolver.alternate(code, tickers)
+        if alt: alternates[code] = alt
+    if alternates:
+        bars.update(fetch(list(alternates.values())))
+        candidates = {code: tickers + ([alternates[code]] if code in alternates else []) for code, tickers in candidates.items()}
+    for tickers in candidates.values():
+        for t in tickers: resolver.observe(t, has_data(t))
+    return bars, candidates
+
+def _ticker_frame(data, ticker, tickers):
+    """從 yf.download(group_by='ticker') 的結果取出單一 ticker (只有一檔時 yfinance 結構不同)"""
+    if isinstance(data.columns, pd.MultiIndex):
+        return data[ticker] if ticker in data.columns.levels[0] else pd.DataFrame()
+    return data if len(tickers) == 1 else pd.DataFrame()
+
+# --- yfinance 批次下載引擎 (分塊 + 有上限的並行 + 只重試失敗的 ticker) ---
+BAR_COLUMNS = ['Open', 'High', 'Low', 'Close', 'Volume']
+YF_CHUNK_MAX = 25 # 單一請求最多幾檔
+YF_CHUNK_MIN = 5
+YF_MAX_WORKERS = 4 # 每一塊內 yfinance 同時發出的請求數
+YF_MAX_RETRIES = 2 # 失敗的 ticker 最多再試幾輪 (每輪分塊減半)
+# yf.download 不丟例外，而是把每個 ticker 的錯誤記在 yf.shared._ERRORS；只有這類暫時性錯誤才重試，
+# 單純沒資料 (週末、假日、開盤前的今天、下市) 不重試
+YF_RETRYABLE_ERRORS = ('rate limit', 'too many requests', '429', 'timeout', 'timed out', 'connection')
+
+def _yf_retryable(tickers):
+    """剛結束的 yf.download 中，因限流/逾時/連線錯誤失敗的 ticker (呼叫端需持有下載鎖)"""
+    errors = {str(k).upper(): str(v).lower() for k, v in getattr(yf.shared, '_ERRORS', {}).items()}
+    return [t for t in tickers if any(p in errors.get(t.upper(), '') for p in YF_RETRYABLE_ERRORS)]
+
+@st.cache_resource
+def get_yf_download_lock():
+    # yf.download 把結果暫存在模組層級的全域變數，同時有兩個呼叫會互相覆蓋，
+    # 所以整個 process 一次只跑一個 yf.download，並行交給 yfinance 自己的 threads
+    return threading.Lock()
+
+def _yf_download_chunk(tickers, kwargs):
+    """下載一塊 ticker，回傳 (長表 list, 因暫時性錯誤要重試的 ticker)"""
+    breaker = get_breaker("yf_history")
+    if not breaker.allow(): return [], list(tickers)
+    try:
+        yf_throttle(len(tickers))
+        with get_yf_download_lock():
+            data = yf.download(tickers, group_by='ticker', progress=False, threads=min(YF_MAX_WORKERS, len(tickers)), **kwargs)
+            retry = _yf_retryable(tickers)
+    except Exception as e:
+        print(f"yf.download Chunk Error ({len(tickers)} tickers): {e}")
+        breaker.record(False)
+        return [], list(tickers)
+    frames = []
+    for ticker in tickers:
+        df = _ticker_frame(data, ticker, tickers)
+        df = df.dropna(subset=['Close']) if 'Close' in df.columns else pd.DataFrame()
+        if df.empty: continue
+        df = df.reindex(columns=BAR_COLUMNS)
+        # 保留交易所當地時間 (日K不會因時區轉換跑到前一天)
+        df.index = pd.DatetimeIndex(df.index).tz_localize(None)
+        frames.append(df.rename_axis('Date').reset_index().assign(ticker=ticker))
+    # 只有例外與限流/逾時這類錯誤算上游失敗；沒資料 (週末、開盤前) 是正常結果，不計入斷路器
+    breaker.record(not retry)
+    return frames, retry
+
+def download_bars(tickers, failed=None, chunk_size=None, **kwargs):
+    """
+    共用的 yf.download：ticker 清單切成適當大小的塊，每塊內以 YF_MAX_WORKERS 個請求並行；
+    某一塊被限流或逾時不會拖垮其他塊，出錯的 ticker 以更小的塊退避重試 (單純沒資料不重試)。
+    kwargs 直接傳給 yf.download (period/start/end/interval)；
+    failed 傳入 list 時，重試完仍出錯的 ticker 會加進去；
+    chunk_size 指定每塊幾檔 (例如走勢這種小批次要一個請求完成)，預設大約切成 4 塊。
+    回傳長表：ticker, Date, Open, High, Low, Close, Volume。
+    """
+    pending = list(dict.fromkeys(tickers))
+    # 大約切成 4 塊：單塊失敗的影響有限，請求數也不會暴增
+    chunk = chunk_size or max(YF_CHUNK_MIN, min(YF_CHUNK_MAX, -(-len(pending) // 4)))
+    frames = []
+    for attempt in range(YF_MAX_RETRIES + 1):
+        if not pending or get_breaker("yf_history").is_open(): break
+        if attempt: time.sleep(random.uniform(0.5, 1.5) * attempt)
+        chunks = [pending[i:i + chunk] for i in range(0, len(pending), chunk)]
+        pending = []
+        for part in chunks:
+            got, retry = _yf_download_chunk(part, kwargs)
+            frames.extend(got)
+            pending.extend(retry)
+        chunk = max(1, chunk // 2)
+    if failed is not None: failed.extend(pending)
+    if not frames: return pd.DataFrame(columns=['ticker', 'Date', *BAR_COLUMNS])
+    return pd.concat(frames, ignore_index=True)[['ticker', 'Date', *BAR_COLUMNS]]
+
+# --- 本地日K資料庫 (只補抓缺少的頭尾日期) ---
+DAILY_BAR_FILE = 'daily_bars.sqlite'
+PERIOD_MONTHS = {'1mo': 1, '3mo': 3, '6mo': 6, '1y': 12, '2y': 24, '5y': 60}
+
+def _tw_today():
+    return datetime.now(pytz.timezone('Asia/Taipei')).date()
+
+def _is_24h_ticker(ticker):
+    # 加密貨幣 (BTC-USD 等) 週末照常交易
+    return ticker.endswith('-USD')
+
+def _last_session_day(ticker, now=None):
+    """最近一個已開盤的交易日 (台股只排除週末與開盤前，國定假日無從得知)"""
+    now = now or datetime.now(pytz.timezone('Asia/Taipei'))
+    d = now.date()
+    if _is_24h_ticker(ticker): return d
+    if (now.hour, now.minute) < TW_SESSION_OPEN: d -= timedelta(days=1)
+    while d.weekday() >= 5: d -= timedelta(days=1)
+    return d
+
+def _has_sessions(ticker, start, end):
+    """start~end (含) 之間有沒有交易日"""
+    if start > end: return False
+    if _is_24h_ticker(ticker) or (end - start).days >= 2: return True
+    return any((start + timedelta(days=i)).weekday() < 5 for i in range((end - start).days + 1))
+
+class DailyBarStore(SQLiteStore):
+    """
+    每個 ticker 的日K (OHLCV) 存在本地 SQLite，coverage 表記錄已完整下載的日期區間。
+    讀取時只向 yfinance 補抓區間外缺少的頭尾日期，其餘直接從磁碟讀；
+    今天的 K 棒還沒定案，不算進覆蓋範圍，每次讀到今天都會重新抓這一根。
+    """
+    def __init__(self, path=DAILY_BAR_FILE):
+        super().__init__(path)
+        self._fetch_lock = threading.Lock() # 同一個 process 內不重複下載同一段
+        self._execute_many([
+            ("CREATE TABLE IF NOT EXISTS bars (ticker TEXT, date TEXT, open REAL, high REAL, low REAL, close REAL, volume REAL, PRIMARY KEY (ticker, date))", ()),
+            ("CREATE TABLE IF NOT EXISTS coverage (ticker TEXT PRIMARY KEY, start TEXT, end TEXT)", ()),
+        ])
+
+    def _coverage(self, tickers):
+        rows = self._execute(f"SELECT ticker, start, end FROM coverage WHERE ticker IN ({','.join('?' * len(tickers))})", tuple(tickers))
+        return {t: (pd.Timestamp(s).date(), pd.Timestamp(e).date()) for t, s, e in rows}
+
+    def _missing_ranges(self, cov, start, end):
+        if cov is None: return [(start, end)]
+        cov_start, cov_end = cov
+        ranges = []
+        if start < cov_start: ranges.append((start, cov_start - timedelta(days=1)))
+        if end > cov_end: ranges.append((cov_end + timedelta(days=1), end))
+        return ranges
+
+    def _download(self, tickers, start, end):
+        """一次批次下載同一段日期的多個 ticker，寫入 bars 並擴大 coverage"""
+        # yfinance 的 end 不含當天
+        failed = []
+        bars = download_bars(tickers, failed=failed, start=start.strftime('%Y-%m-%d'), end=(end + timedelta(days=1)).strftime('%Y-%m-%d'))
+        # 整批都沒資料也要往下走：停牌的 ticker 仍要記 coverage，否則每次讀取都會重抓
+        dates = pd.to_datetime(bars['Date']).dt.strftime('%Y-%m-%d')
+        values = bars[BAR_COLUMNS].astype(float).values.tolist() # NaN 寫入 SQLite 會變成 NULL
+        rows = [(t, d, *v) for t, d, v in zip(bars['ticker'], dates, values)]
+        # coverage 只記真的拿到資料的 ticker，以及沒出錯、只是這段沒成交的 (停牌)；
+        # 被限流或重試後仍失敗的不記，下次讀取會再補抓
+        got = set(bars['ticker'])
+        covered = [t for t in tickers if t in got or t not in failed]
+        settled_end = min(end, _tw_today() - timedelta(days=1))
+        cov_rows = [(t, start.isoformat(), settled_end.isoformat()) for t in covered] if settled_end >= start else []
+        self._execute_many([
+            ("INSERT OR REPLACE INTO bars VALUES (?, ?, ?, ?, ?, ?, ?)", rows),
+            ("INSERT INTO coverage VALUES (?, ?, ?) ON CONFLICT(ticker) DO UPDATE SET start = min(start, excluded.start), end = max(end, excluded.end)", cov_rows),
+        ])
+
+    def get_bars(self, tickers, start, end=None):
+        """
+        回傳 {ticker: DataFrame(Open/High/Low/Close/Volume，index 為日期)}，日期區間含頭尾。
+        已存過的日期不會再打網路；缺的頭尾同一段日期的 ticker 合併成一次下載。
+        """
+        tickers = list(dict.fromkeys(tickers))
+        if not tickers: return {}
+        start = pd.Timestamp(start).date()
+        end = min(pd.Timestamp(end).date() if end is not None else _tw_today(), _tw_today())
+
+        with self._fetch_lock:
+            coverage = self._coverage(tickers)
+            pending = {}
+            for ticker in tickers:
+                # 只抓到最近一個已開盤的交易日：週末、開盤前不會為了今天空的 K 棒打網路
+                t_end = min(end, _last_session_day(ticker))
+                for rng in self._missing_ranges(coverage.get(ticker), start, t_end):
+                    if _has_sessions(ticker, *rng): pending.setdefault(rng, []).append(ticker)
+            for (r_start, r_end), group in pending.items():
+                self._download(group, r_start, r_end)
+
+        rows = self._execute(
+            f"SELECT ticker, date, open, high, low, close, volume FROM bars WHERE ticker IN ({','.join('?' * len(tickers))}) AND date BETWEEN ? AND ? ORDER BY date",
+            (*tickers, start.isoformat(), end.isoformat()))
+        all_bars = pd.DataFrame(rows, columns=['ticker', 'Date', *BAR_COLUMNS])
+        all_bars['Date'] = pd.to_datetime(all_bars['Date'])
+        grouped = {t: g.drop(columns='ticker').set_index('Date') for t, g in all_bars.groupby('ticker')}
+        return {t: grouped.get(t, pd.DataFrame(columns=BAR_COLUMNS)) for t in tickers}
+
+@st.cache_resource
+def get_daily_bar_store():
+    return DailyBarStore()
+
 # 別名對照
 ALIAS_MAP = {
     "京元電": "京元電子", "亞翔工程": "亞翔", "聖暉*": "聖暉", "聖暉工程": "聖暉",
@@ -401,7 +1762,104 @@ def smart_get_code(stock_name):
     return code
 
 # --- 【V145】預先批次抓取成交值 (終極修復：加入 Fast Info 即時救援) ---
-@st.cache_data(ttl=300)
+# --- Fast Info 並行救援 (History 還沒更新的早盤) ---
+TURNOVER_RESCUE_WORKERS = 8
+TURNOVER_RESCUE_DEADLINE_SEC = 5 # 整批救援最多等幾秒，超過的先顯示 ⏳
+TURNOVER_RESCUE_TTL = 300
+TURNOVER_PENDING = float('nan') # 成交值還在救援中的標記
+
+def is_turnover_pending(val):
+    return isinstance(val, float) and pd.isna(val)
+
+class FastInfoRescue:
+    """
+    跨 Session 共用的 fast_info 救援池 (thread-safe)。
+    同一檔股票同時只會有一個請求；超過 deadline 才回來的結果也會留著，
+    下一次重新整理直接取用。
+    """
+    def __init__(self, max_workers=TURNOVER_RESCUE_WORKERS, ttl=TURNOVER_RESCUE_TTL):
+        self.ttl = ttl
+        self._executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix="fast-info")
+        self._lock = threading.Lock()
+        self._inflight = {} # {code: Future}
+        self._results = {} # {code: (成交值, 抓取時間)}
+
+    def _fetch(self, code, tickers):
+        found_val = 0
+        breaker = get_breaker("yf_fast_info")
+        try:
+            for ticker in tickers:
+                if not breaker.allow(): break
+                try:
+                    yf_throttle()
+                    fi = yf.Ticker(ticker).fast_info
+                    # 檢查是否有今日數據
+                    last_price = fi.get('last_price', 0)
+                    last_vol = fi.get('last_volume', 0)
+                    breaker.record(True)
+                    
+                    # 簡單檢核：如果價格>0且量>0，就當作是有效的
+                    if last_price > 0 and last_vol > 0:
+                        get_exchange_resolver().observe(ticker, True)
+                        val = (last_price * last_vol) / 100000000
+                        if val > 0.01:
+                            found_val = val
+                            break
+                except Exception:
+                    breaker.record(False)
+        finally:
+            with self._lock:
+                self._results[code] = (found_val, time.time())
+                self._inflight.pop(code, None)
+        return found_val
+
+    def rescue(self, candidates, deadline=TURNOVER_RESCUE_DEADLINE_SEC):
+        """candidates: {代號: [ticker...]}。回傳 {代號: 成交值 (0 = 查無, TURNOVER_PENDING = 還在抓)}"""
+        results, futures = {}, {}
+        now = time.time()
+        # fast_info 斷路中：沒快取的直接當查無 (不寫入快取，恢復後會重抓)
+        tripped = get_breaker("yf_fast_info").is_open()
+        with self._lock:
+            for code, tickers in candidates.items():
+                hit = self._results.get(code)
+                if hit and now - hit[1] < self.ttl:
+                    results[code] = hit[0]
+                    continue
+                fut = self._inflight.get(code)
+                if fut is None and tripped:
+                    results[code] = 0
+                    continue
+                if fut is None:
+                    fut = self._inflight[code] = self._executor.submit(self._fetch, code, tickers)
+                futures[fut] = code
+        if futures:
+            done, _ = wait(futures, timeout=deadline)
+            for fut, code in futures.items():
+                results[code] = fut.result() if fut in done else TURNOVER_PENDING
+        get_exchange_resolver().flush()
+        return results
+
+@st.cache_resource
+def get_fast_info_rescue():
+    return FastInfoRescue()
+
+# 還有救援中的股票時視為過期，下一次 rerun 就在背景補上
+@swr_cache(ttl=MarketSessionTTL(300), stale_if=lambda v: any(is_turnover_pending(x) for x in v.values()))
+def parse_manual_turnover(manual_override_json):
+    """管理員手動輸入的成交值 (JSON {名稱或代號: 億})，原始 key、代號、名稱都可以查到"""
+    result_map = {}
+    if not manual_override_json: return result_map
+    try:
+        manual_data = json.loads(manual_override_json)
+        if isinstance(manual_data, dict):
+            for k, v in manual_data.items():
+                result_map[k] = float(v)
+                code, name, _ = smart_get_code_and_sector(k)
+                if code: result_map[code] = float(v)
+                if name: result_map[name] = float(v)
+    except: pass
+    return result_map
+
 def prefetch_turnover_data(stock_list_str, target_date, manual_override_json=None):
     if not stock_list_str: stock_list_str = []
     unique_names = set()
@@ -411,34 +1869,23 @@ def prefetch_turnover_data(stock_list_str, target_date, manual_override_json=Non
         for name in names:
             unique_names.add(name.replace("(CB)", ""))
             
-    result_map = {}
-    
     # 1. Manual Override
-    if manual_override_json:
-        try:
-            manual_data = json.loads(manual_override_json)
-            if isinstance(manual_data, dict):
-                for k, v in manual_data.items():
-                    result_map[k] = float(v)
-                    code, name, _ = smart_get_code_and_sector(k)
-                    if code: result_map[code] = float(v)
-                    if name: result_map[name] = float(v)
-        except: pass
+    result_map = parse_manual_turnover(manual_override_json)
 
     # 2. 準備爬蟲名單
     to_fetch_names = [name for name in unique_names if name not in result_map]
     if not to_fetch_names: return result_map
 
     code_map = {}
-    tickers = []
     for name in to_fetch_names:
         code, db_name, _ = smart_get_code_and_sector(name)
         if code:
             code_map[code] = name 
-            tickers.append(f"{code}.TW")
-            tickers.append(f"{code}.TWO")
-            
-    if not tickers: return result_map
+
+    # 只下載已知交易所的那一個 ticker (未知的才兩個都試)
+    resolver = get_exchange_resolver()
+    candidates = resolver.candidates(code_map)
+    if not candidates: return result_map
     
     # 3. 嘗試批次下載 (History)
     try:
@@ -446,67 +1893,58 @@ def prefetch_turnover_data(stock_list_str, target_date, manual_override_json=Non
         start_dt = t_date_dt - timedelta(days=5) 
         end_dt = t_date_dt + timedelta(days=2)
         
-        start_str = start_dt.strftime("%Y-%m-%d")
-        end_str = end_dt.strftime("%Y-%m-%d")
-        
-        # 使用 threads=True 加速
-        data = yf.download(tickers, start=start_str, end=end_str, group_by='ticker', progress=False, threads=False)
+        # 本地日K資料庫：歷史日期直接讀磁碟，只補抓缺少的日期 (猜錯交易所的同一次補抓另一個)
+        store = get_daily_bar_store()
+        bars, candidates = fetch_with_exchange_fallback(resolver, candidates, lambda ts: store.get_bars(ts, start_dt, end_dt))
+        missed = {} # {code: name}，History 找不到的
         
         for code, name in code_map.items():
             found_val = 0
             # A. 先試 History Data
-            for suffix in ['.TW', '.TWO']:
+            for ticker in candidates[code]:
                 try:
-                    ticker = f"{code}{suffix}"
-                    if ticker in data.columns.levels[0]:
-                        df = data[ticker]
-                        if not df.empty:
-                            df.index = df.index.tz_localize(None).normalize()
-                            target_ts = t_date_dt.normalize()
-                            
-                            # 優先抓取 target_date
-                            if target_ts in df.index:
-                                row = df.loc[target_ts]
-                            else:
-                                # 抓最近的一筆
-                                valid_rows = df[df.index <= target_ts]
-                                if not valid_rows.empty: row = valid_rows.iloc[-1]
-                                else: continue
-                                    
-                            price = float(row['Close'])
-                            vol = float(row['Volume'])
-                            if price > 0 and vol > 0:
-                                val = (price * vol) / 100000000
-                                if val > 0.01:
-                                    found_val = val
-                                    break
-                except: pass
-            
-            # B. 【關鍵修復】如果 History 抓不到 (found_val=0)，改用 Fast Info (即時數據)
-            if found_val == 0:
-                for suffix in ['.TW', '.TWO']:
-                    try:
-                        ticker_obj = yf.Ticker(f"{code}{suffix}")
-                        fi = ticker_obj.fast_info
-                        # 檢查是否有今日數據
-                        last_price = fi.get('last_price', 0)
-                        last_vol = fi.get('last_volume', 0)
+                    df = bars[ticker]
+                    if not df.empty:
+                        target_ts = t_date_dt.normalize()
                         
-                        # 簡單檢核：如果價格>0且量>0，就當作是有效的
-                        if last_price > 0 and last_vol > 0:
-                            val = (last_price * last_vol) / 100000000
+                        # 優先抓取 target_date
+                        if target_ts in df.index:
+                            row = df.loc[target_ts]
+                        else:
+                            # 抓最近的一筆
+                            valid_rows = df[df.index <= target_ts]
+                            if not valid_rows.empty: row = valid_rows.iloc[-1]
+                            else: continue
+                                
+                        price = float(row['Close'])
+                        vol = float(row['Volume'])
+                        if price > 0 and vol > 0:
+                            val = (price * vol) / 100000000
                             if val > 0.01:
                                 found_val = val
                                 break
-                    except: pass
-
+                except: pass
+            
             if found_val > 0:
                 result_map[name] = found_val
                 result_map[code] = found_val
+            else:
+                missed[code] = name
+
+        # B. 【關鍵修復】History 抓不到的改用 Fast Info (即時數據)，並行救援
+        # 超過 deadline 還沒回來的標記為 TURNOVER_PENDING，下次重新整理時補上
+        if missed:
+            rescued = get_fast_info_rescue().rescue({code: candidates[code] for code in missed})
+            for code, val in rescued.items():
+                if val == 0: continue
+                result_map[missed[code]] = val
+                result_map[code] = val
                 
         return result_map
     except Exception as e:
         return result_map
+    finally:
+        resolver.flush()
 
 
 # --- 修正後的繪圖函式：加入數據正規化 ---
@@ -611,6 +2049,7 @@ from datetime import datetime
 import pytz # 確保有導入時區庫，用於判斷台股日期
 
 # --- [V210 終極版] 串接證交所官方 MIS API 獲取最權威指數資料 ---
+@swr_cache(ttl=MarketSessionTTL(20))
 def fetch_official_tw_index_data():
     """
     直接請求台灣證券交易所基本市況報導網站 (MIS) 的 API。
@@ -626,13 +2065,18 @@ def fetch_official_tw_index_data():
     }
     
     results = {}
+    # 連續被擋時直接回空結果，呼叫端改走 yfinance，不必每次等 timeout
+    breaker = get_breaker("mis")
+    if not breaker.allow(): return results
     try:
-        # 加入一個隨機參數避免快取
+        # 加入一個隨機參數避免快取；重試交給斷路器，不在這裡重複等 timeout
         timestamp = int(time.time() * 1000)
-        r = requests.get(f"{api_url}&_={timestamp}", headers=headers, timeout=5)
+        r = get_http_client().get(f"{api_url}&_={timestamp}", headers=headers, timeout=5, retries=0)
         
-        if r.status_code == 200:
-            data = r.json()
+        # 被擋時常回 200 的 HTML 頁，要能解析出 msgArray 才算成功
+        data = r.json() if r.status_code == 200 else {}
+        breaker.record('msgArray' in data)
+        if data:
             if 'msgArray' not in data: return {}
             
             for item in data['msgArray']:
@@ -663,115 +2107,296 @@ def fetch_official_tw_index_data():
                             "change": change,
                             "pct_change": pct_change
                         }
+    except (requests.RequestException, ValueError) as e:
+        breaker.record(False)
+        print(f"Official TW API error: {e}")
     except Exception as e:
         print(f"Official TW API error: {e}")
         
     return results
 
+class MarketSnapshot:
+    """
+    單次 render 共用的行情快照：同一輪畫面裡每個上游報價只抓一次，
+    讓大盤卡片、風度儀表與指數即時資料使用同一個價格、只付一次 round trip。
+    傳入 QuotePoller 發布的快照 (published) 時直接讀它，只有快照還沒有的資料才自己抓。
+    poller 閒置過 (快照太久沒檢查) 時不使用快照：過期的報價同步重抓，不把幾小時前的價格當即時顯示。
+    """
+    def __init__(self, published=None, poller=None):
+        self._memo = {}
+        checked_at = (published or {}).get('checked_at')
+        self.fresh = checked_at is not None and time.time() - checked_at <= QUOTE_SNAPSHOT_MAX_AGE_SEC
+        self.published = published if self.fresh else {}
+        self.poller = poller
+
+    def _get(self, key, fetch):
+        if key not in self._memo:
+            self._memo[key] = fetch()
+        return self._memo[key]
+
+    def _current(self, fetcher, *args):
+        # 沒有新鮮快照時：快取已過期就同步重抓，而不是先回傳舊值再背景更新
+        remaining = fetcher.expires_in(*args)
+        if remaining is not None and remaining <= 0: fetcher.refresh(*args)
+        return fetcher(*args)
+
+    def tw_official(self):
+        """MIS 官方加權/櫃買報價 (整輪 render 只打一次)"""
+        return self._get('tw_official', lambda: self.published.get('tw_official') or self._current(fetch_official_tw_index_data))
+
+    def index_live(self, symbol, official_key=None):
+        published = self.published.get('index', {}).get(symbol)
+        if published and official_key == symbol: return published
+        def fetch():
+            if official_key not in self.tw_official(): self._current(_get_index_yf_quote, symbol)
+            return get_index_live_data(symbol, official_key, snapshot=self)
+        return self._get(('index_live', symbol, official_key), fetch)
+
+    def cards(self):
+        """全球卡片 (copy，呼叫端會覆蓋台股報價)；快照還沒有時回傳 None"""
+        cards = self.published.get('cards')
+        return copy.deepcopy(cards) if cards else None
+
+    def turnover(self, stock_list_str, target_date, manual_override_json=None):
+        """策略選股成交值：登記給 poller 持續更新，快照有就直接用"""
+        args = (stock_list_str, target_date, manual_override_json)
+        key = None
+        # 過去日期的成交值不會再變，不必登記輪詢
+        if self.poller is not None and target_date == _tw_today().strftime('%Y-%m-%d'):
+            key = self.poller.watch(prefetch_turnover_data, args)
+        published = self.published.get('watched', {}).get(key)
+        if published is not None: return published
+        return prefetch_turnover_data(*args)
+
+def _apply_official_quotes(markets, official_data):
+    """用本輪快照的官方報價覆蓋卡片上的台股指數，讓卡片與風度儀表一致"""
+    for m in markets:
+        data = official_data.get(m.get('ticker'))
+        if not data or data.get('price') is None: continue
+        # 串流推播的報價可能只有價格，漲跌欄位缺少時以 0 計
+        change = data.get('change', 0)
+        m['price'] = f"{data['price']:,.2f}"
+        m['change'] = change
+        m['pct_change'] = data.get('pct_change', 0)
+        m['color_hex'] = "#DC2626" if change > 0 else ("#059669" if change < 0 else "#6B7280")
+    return markets
+
+
+# --- 全球市場即時報價 (V210: 官方訊號源終極版 / 並行抓取) ---
+GLOBAL_MARKET_INDICES = {
+    "^TWII": "🇹🇼 加權指數", 
+    "^TWOII": "🇹🇼 櫃買指數", 
+    "^N225": "🇯🇵 日經225",
+    "^DJI": "🇺🇸 道瓊工業", 
+    "^IXIC": "🇺🇸 那斯達克", 
+    "^SOX": "🇺🇸 費城半導體",
+    "BTC-USD": "₿ 比特幣", 
+    "ETH-USD": "Ξ 乙太幣"
+}
+GLOBAL_CARD_DEADLINE_SEC = 8 # 單一 ticker 最多等幾秒，超過就先不畫這張卡
 
-# --- 全球市場即時報價 (V210: 官方訊號源終極版) ---
-@st.cache_data(ttl=20)
-def get_global_market_data_with_chart():
-    try:
-        indices = {
-            "^TWII": "🇹🇼 加權指數", 
-            "^TWOII": "🇹🇼 櫃買指數", 
-            "^N225": "🇯🇵 日經225",
-            "^DJI": "🇺🇸 道瓊工業", 
-            "^IXIC": "🇺🇸 那斯達克", 
-            "^SOX": "🇺🇸 費城半導體",
-            "BTC-USD": "₿ 比特幣", 
-            "ETH-USD": "Ξ 乙太幣"
-        }
-        market_data = []
+@st.cache_resource
+def get_market_fetch_executor():
+    # 跨 Session 共用的 thread pool：超時的 ticker 會在背景跑完，不會卡住畫面
+    return ThreadPoolExecutor(max_workers=len(GLOBAL_MARKET_INDICES) + 2, thread_name_prefix="market-card")
 
-        # 【V210 新增】優先一次性抓取台股官方資料
-        tw_official_data = fetch_official_tw_index_data()
-        
-        for ticker_code, name in indices.items():
-            try:
-                # 1. 初始化變數
-                last_price = None
-                change = 0
-                pct_change = 0
-                
-                # 2. 決定價格數據來源 (Price Source)
-                # 【策略 A】台灣指數：直接使用官方 API 結果
-                if ticker_code in ["^TWII", "^TWOII"] and ticker_code in tw_official_data:
-                    data = tw_official_data[ticker_code]
-                    last_price = data['price']
-                    change = data['change']
-                    pct_change = data['pct_change']
-                
-                # 【策略 B】國際指數 或 官方 API 沒抓到：使用 yfinance fast_info
-                stock = yf.Ticker(ticker_code)
-                if last_price is None:
-                    try:
-                        fi = stock.fast_info
-                        if fi.last_price is not None and fi.previous_close is not None:
-                            last_price = float(fi.last_price)
-                            prev_close = float(fi.previous_close)
-                            # 簡單防呆，避免昨收為 0
-                            if prev_close > 0:
-                                change = last_price - prev_close
-                                pct_change = (change / prev_close) * 100
-                    except: pass
-
-                # 3. 準備走勢圖數據 (Trend - Sparkline)
-                # 統一使用 yfinance 抓歷史資料畫圖
-                is_crypto = "-USD" in ticker_code
-                interval = "15m" if is_crypto else "5m"
-                
-                hist_intra = stock.history(period="1d", interval=interval)
-                # 資料不足的補救措施 (例如剛開盤或假日)
-                if hist_intra.empty or len(hist_intra) < 5:
-                    hist_intra = stock.history(period="5d", interval="60m")
-                if hist_intra.empty:
-                    hist_intra = stock.history(period="1mo", interval="1d")
-                
-                trend_data = hist_intra['Close'].dropna().tolist()
-                
-                # 4. 最終防呆
-                # 如果真的完全沒價格，嘗試用走勢圖最後一點 (最後手段)
-                if last_price is None and trend_data:
-                    last_price = trend_data[-1]
-                
-                if last_price is None: continue
+GLOBAL_TREND_MIN_BARS = 5 # 盤中 K 棒少於這個數量就改用較粗的週期
 
-                # 5. 格式化輸出
-                color_hex = "#DC2626" if change > 0 else ("#059669" if change < 0 else "#6B7280")
-                
-                market_data.append({
-                    "name": name, 
-                    "price": f"{last_price:,.2f}", 
-                    "change": change, 
-                    "pct_change": pct_change, 
-                    "color_hex": color_hex,
-                    "trend": trend_data
-                })
-                
-            except Exception as e:
-                print(f"Error processing {ticker_code}: {e}")
-                continue
-        return market_data
+def _fetch_market_quote(ticker_code):
+    """fast_info 報價，回傳 (最新價, 漲跌, 漲跌幅)；抓不到時最新價為 None"""
+    breaker = get_breaker("yf_fast_info")
+    if not breaker.allow(): return None, 0, 0
+    try:
+        yf_throttle()
+        fi = yf.Ticker(ticker_code).fast_info
+        breaker.record(True)
+        if fi.last_price is not None and fi.previous_close is not None:
+            last_price = float(fi.last_price)
+            prev_close = float(fi.previous_close)
+            # 簡單防呆，避免昨收為 0
+            if prev_close > 0:
+                change = last_price - prev_close
+                return last_price, change, (change / prev_close) * 100
+            return last_price, 0, 0
     except Exception as e:
-        print(f"Global market data fatal error: {e}")
-        return []		
+        breaker.record(False)
+        print(f"Quote Error ({ticker_code}): {e}")
+    return None, 0, 0
+
+def _download_trend_batch(tickers, interval):
+    """
+    一次批次下載多個 ticker 的走勢 (Close)，回傳 {ticker: [價格...]}。
+    盤中 K 棒不足的 ticker 一起改抓 5d/60m，仍然沒有資料的再一起抓 1mo/1d
+    (例如剛開盤或假日)，每一階只對還需要的 ticker 發一個請求。
+    """
+    trends = {}
+    pending = list(tickers)
+    for period, iv, min_bars in (("1d", interval, GLOBAL_TREND_MIN_BARS), ("5d", "60m", 1), ("1mo", "1d", 1)):
+        if not pending: break
+        bars = download_bars(pending, chunk_size=len(pending), period=period, interval=iv)
+        # 向量化判斷：各 ticker 的有效 K 棒數
+        bar_counts = bars.groupby('ticker')['Close'].count().reindex(pending, fill_value=0)
+        enough = set(bar_counts.index[bar_counts >= min_bars])
+        for ticker, g in bars[bars['ticker'].isin(enough)].groupby('ticker'):
+            trends[ticker] = g.sort_values('Date')['Close'].tolist()
+        pending = [t for t in pending if t not in trends]
+    return trends
+
+def _build_market_card(ticker_code, name, quote, trend_data):
+    last_price, change, pct_change = quote
+    # 最終防呆：如果真的完全沒價格，嘗試用走勢圖最後一點 (最後手段)
+    if last_price is None and trend_data:
+        last_price = trend_data[-1]
+    if last_price is None: return None
+
+    color_hex = "#DC2626" if change > 0 else ("#059669" if change < 0 else "#6B7280")
+    return {
+        "ticker": ticker_code,
+        "name": name, 
+        "price": f"{last_price:,.2f}", 
+        "change": change, 
+        "pct_change": pct_change, 
+        "color_hex": color_hex,
+        "trend": trend_data
+    }
+
+def iter_global_market_cards(deadline=GLOBAL_CARD_DEADLINE_SEC):
+    """
+    報價 (每個 ticker 一個 fast_info) 與走勢 (股指一個批次、加密貨幣一個批次) 同時送進 thread pool，
+    某個 ticker 的報價與走勢都到齊就 yield (原始順位, 卡片)。
+    整條卡片的延遲 = 最慢的那個請求 (上限 deadline 秒)，而不是全部加總。
+    """
+    executor = get_market_fetch_executor()
+    tickers = list(GLOBAL_MARKET_INDICES)
+    groups = {}
+    for ticker in tickers:
+        groups.setdefault("-USD" in ticker, []).append(ticker)
+    # 加密貨幣 24 小時交易，用 15 分 K；股指用 5 分 K
+    trend_futures = {executor.submit(_download_trend_batch, group, "15m" if is_crypto else "5m"): group for is_crypto, group in groups.items()}
+    quote_futures = {executor.submit(_fetch_market_quote, ticker): ticker for ticker in tickers}
+
+    quotes, trends, trend_done = {}, {}, set()
+    def card_for(ticker):
+        return _build_market_card(ticker, GLOBAL_MARKET_INDICES[ticker], quotes[ticker], trends.get(ticker, []))
+
+    try:
+        for fut in as_completed([*trend_futures, *quote_futures], timeout=deadline):
+            if fut in quote_futures:
+                ticker = quote_futures[fut]
+                quotes[ticker] = fut.result()
+                ready = [ticker] if ticker in trend_done else []
+            else:
+                group = trend_futures[fut]
+                try:
+                    trends.update(fut.result())
+                except Exception as e:
+                    print(f"Trend Batch Error ({group}): {e}")
+                trend_done.update(group)
+                ready = [t for t in group if t in quotes]
+            for ticker in ready:
+                card = card_for(ticker)
+                if card: yield tickers.index(ticker), card
+    except FuturesTimeout:
+        late = [t for t in tickers if t not in quotes or t not in trend_done]
+        print(f"Global market cards timed out: {late}")
+        # 報價已到但走勢批次超時：先畫沒有走勢圖的卡片
+        for ticker in late:
+            if ticker in quotes:
+                card = card_for(ticker)
+                if card: yield tickers.index(ticker), card
+
+def _order_market_cards(indexed_cards):
+    return [card for _, card in sorted(indexed_cards, key=lambda x: x[0])]
+
+# 台股官方資料 (MIS) 不在這裡抓：由 render 時的 MarketSnapshot 統一取得後覆蓋
+# (見 _apply_official_quotes)，避免同一輪畫面重複呼叫 MIS
+# 卡片含加密貨幣與海外指數，台股收盤後仍在交易，維持固定 ttl
+@swr_cache(ttl=20)
+def get_global_market_data_with_chart():
+    return _order_market_cards(iter_global_market_cards())
+
+# --- 恐懼與貪婪指數歷史 ---
+FEAR_GREED_HISTORY_FILE = 'fear_greed_history.sqlite'
+FEAR_GREED_URL = "https://production.dataviz.cnn.io/index/fearandgreed/graphdata"
+FEAR_GREED_OVERLAP_DAYS = 3 # 增量更新時往回多抓幾天，CNN 會修正最近幾個點
+
+class FearGreedHistory(SQLiteStore):
+    """
+    CNN 恐懼貪婪指數的歷史序列 (時間戳 ms, 分數)，存在本地 SQLite。
+    記憶體內保留依時間排序的兩個陣列，回溯查詢用二分搜尋 (O(log n))；
+    每次只併入比最後一筆新 (或在重疊區內) 的點，不必每次重讀整段歷史。
+    """
+    def __init__(self, path=FEAR_GREED_HISTORY_FILE):
+        super().__init__(path)
+        self._lock = threading.Lock()
+        self._execute("CREATE TABLE IF NOT EXISTS points (ts REAL PRIMARY KEY, score REAL NOT NULL)")
+        rows = self._execute("SELECT ts, score FROM points ORDER BY ts")
+        self._ts = [r[0] for r in rows]
+        self._scores = [r[1] for r in rows]
+
+    def last_ts(self):
+        with self._lock:
+            return self._ts[-1] if self._ts else None
+
+    def merge(self, points):
+        """併入 [(ts, score)]；同一時間點以新值為準，回傳實際新增/修改的筆數"""
+        changed = []
+        with self._lock:
+            for ts, score in sorted(points):
+                i = bisect.bisect_left(self._ts, ts)
+                if i < len(self._ts) and self._ts[i] == ts:
+                    if self._scores[i] == score: continue
+                    self._scores[i] = score
+                elif i == len(self._ts):
+                    self._ts.append(ts); self._scores.append(score)
+                else:
+                    self._ts.insert(i, ts); self._scores.insert(i, score)
+                changed.append((ts, score))
+        if changed: self._execute_many([("INSERT OR REPLACE INTO points VALUES (?, ?)", changed)])
+        return len(changed)
+
+    def nearest(self, ts):
+        """最接近 ts 的一點 (ts, score)；沒有資料回傳 None"""
+        with self._lock:
+            if not self._ts: return None
+            i = bisect.bisect_left(self._ts, ts)
+            # 只需比較插入點左右兩個鄰居
+            if i == len(self._ts) or (i > 0 and ts - self._ts[i - 1] <= self._ts[i] - ts): i -= 1
+            return self._ts[i], self._scores[i]
+
+    def series(self, since_ts=None):
+        """since_ts 之後的歷史 (DataFrame: date, score)，切片位置同樣用二分搜尋"""
+        with self._lock:
+            i = bisect.bisect_left(self._ts, since_ts) if since_ts is not None else 0
+            ts, scores = self._ts[i:], self._scores[i:]
+        return pd.DataFrame({"date": pd.to_datetime(ts, unit='ms'), "score": scores})
+
+@st.cache_resource
+def get_fear_greed_history():
+    return FearGreedHistory()
 
 # --- 恐懼與貪婪指數 (V154: 結構相容修復版) ---
-@st.cache_data(ttl=300) 
+@swr_cache(ttl=300, is_valid=lambda v: bool(v) and "error" not in v)
 def get_cnn_fear_greed_full():
-    url = "https://production.dataviz.cnn.io/index/fearandgreed/graphdata"
+    breaker = get_breaker("cnn")
+    if not breaker.allow(): return {"error": "CNN 連線連續失敗，暫停請求中"}
+    store = get_fear_greed_history()
+    last_ts = store.last_ts()
+    url = FEAR_GREED_URL
+    if last_ts:
+        # 已有歷史：只要求最後一筆前幾天之後的資料
+        since = datetime.fromtimestamp(last_ts / 1000) - timedelta(days=FEAR_GREED_OVERLAP_DAYS)
+        url = f"{FEAR_GREED_URL}/{since.strftime('%Y-%m-%d')}"
     headers = {
         "User-Agent": "Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/120.0.0.0 Safari/537.36",
         "Referer": "https://www.cnn.com/",
         "Origin": "https://www.cnn.com",
-        "Connection": "keep-alive",
         "Cache-Control": "no-cache", 
         "Pragma": "no-cache"
     }
     try:
-        r = requests.get(url, headers=headers, timeout=10)
+        r = get_http_client().get(url, headers=headers, timeout=10)
+        breaker.record(r.status_code == 200)
         if r.status_code == 200:
             data = r.json()
             
@@ -789,15 +2414,18 @@ def get_cnn_fear_greed_full():
             timestamp = safe_ts(fg_obj.get('timestamp'))
             
             history_data = data.get('fear_and_greed_historical', {}).get('data', [])
+            points = []
+            for x in history_data:
+                try: points.append((float(x['x']), float(x['y'])))
+                except (KeyError, TypeError, ValueError): continue
+            store.merge(points)
             
-            # 搜尋歷史數據 helper
+            # 搜尋歷史數據 helper (本地排序序列上的二分搜尋)
             def get_past(days):
-                if not history_data: return None, None
                 target = (datetime.now() - timedelta(days=days)).timestamp() * 1000
-                closest = min(history_data, key=lambda x: abs((float(x['x']) if 'x' in x else 0) - target))
-                try: 
-                    return round(float(closest['y']), 1), datetime.fromtimestamp(float(closest['x'])/1000).strftime('%Y/%m/%d')
-                except: return None, None
+                closest = store.nearest(target)
+                if closest is None: return None, None
+                return round(closest[1], 1), datetime.fromtimestamp(closest[0]/1000).strftime('%Y/%m/%d')
 
             p_sc, p_dt = get_past(1)
             w_sc, w_dt = get_past(7)
@@ -818,6 +2446,9 @@ def get_cnn_fear_greed_full():
                 }
             }
         return {"error": f"HTTP {r.status_code}"}
+    except requests.RequestException as e:
+        breaker.record(False)
+        return {"error": str(e)}
     except Exception as e: return {"error": str(e)}
 
 def get_rating_label_cn(score):
@@ -831,6 +2462,21 @@ def get_rating_label_cn(score):
 import math
 import plotly.graph_objects as go
 
+# --- 恐懼貪婪歷史走勢 ---
+FEAR_GREED_CHART_RANGES = {"1個月": 30, "6個月": 182, "1年": 365, "全部": None}
+
+def plot_fear_greed_history(df):
+    """歷史分數折線，背景依 恐懼/中性/貪婪 區間上色 (與儀表板同色)"""
+    fig = go.Figure()
+    bands = [(0, 25, '#91cf60'), (25, 45, '#d9ef8b'), (45, 55, '#fee08b'), (55, 75, '#fc8d59'), (75, 100, '#d73027')]
+    for lo, hi, col in bands:
+        fig.add_hrect(y0=lo, y1=hi, fillcolor=col, opacity=0.15, line_width=0, layer="below")
+    fig.add_trace(go.Scatter(x=df['date'], y=df['score'], mode='lines', line=dict(color='#333', width=1.5),
+                             hovertemplate='%{x|%Y/%m/%d}<br>%{y:.1f}<extra></extra>', showlegend=False))
+    fig.update_layout(height=260, margin=dict(l=10, r=10, t=10, b=10), yaxis=dict(range=[0, 100]),
+                      plot_bgcolor='white', paper_bgcolor='white')
+    return fig
+
 # --- [V1000 終極修正版] 恐懼貪婪儀表板 (已移除中間的 \ 線條) ---
 def plot_fear_greed_gauge_dark(score):
     # 1. 顏色定義
@@ -995,17 +2641,8 @@ def plot_fear_greed_gauge_dark(score):
 import textwrap # 務必確認有匯入這個標準函式庫
 
 # --- 2. 渲染函式 (防呆修正版：解決縮排導致的黑框問題) ---
-def render_global_markets():
-    st.markdown("### 🌏 全球指數與加密貨幣 (Real-time Trend)")
-    
-    markets = get_global_market_data_with_chart()
-    
-    if not markets:
-        st.info("⏳ 市場資料讀取中...")
-        st.divider()
-        return
-
-    # --- 1. 產生卡片 HTML ---
+def _market_cards_html(markets):
+    """產生卡片 HTML"""
     cards_list = []
     for m in markets:
         svg_chart = make_sparkline_svg(m['trend'], m['color_hex'], height=50)
@@ -1025,8 +2662,15 @@ def render_global_markets():
         cards_list.append(card_html)
 
     all_cards_str = "".join(cards_list)
+    return f'<div class="market-dashboard-grid">{all_cards_str}</div>'
 
-    # --- 2. CSS 樣式 (優化版) ---
+def render_global_markets(snapshot=None):
+    st.markdown("### 🌏 全球指數與加密貨幣 (Real-time Trend)")
+    
+    if snapshot is None: snapshot = MarketSnapshot()
+    official_data = snapshot.tw_official()
+
+    # --- 1. CSS 樣式 (優化版) ---
     css_styles = """
     <style>
         /* --- 電腦版佈局 (Grid) --- */
@@ -1092,10 +2736,31 @@ def render_global_markets():
     </style>
     """
 
-    final_html = f'<div class="market-dashboard-grid">{all_cards_str}</div>'
-
     st.markdown(css_styles, unsafe_allow_html=True)
-    st.markdown(final_html, unsafe_allow_html=True)
+    cards_slot = st.empty()
+
+    # --- 2. 產生卡片 (冷啟動時逐張到齊就先畫，不等最慢的 ticker) ---
+    published_cards = snapshot.cards()
+    if published_cards is None and get_global_market_data_with_chart.cache_info() is None:
+        arrived = []
+        for i, card in iter_global_market_cards():
+            arrived.append((i, card))
+            cards_slot.markdown(_market_cards_html(_apply_official_quotes(_order_market_cards(arrived), official_data)), unsafe_allow_html=True)
+        get_global_market_data_with_chart.set(_order_market_cards(arrived))
+
+    markets = _apply_official_quotes(published_cards or get_global_market_data_with_chart(), official_data)
+    if not markets:
+        cards_slot.info("⏳ 市場資料讀取中...")
+        st.divider()
+        return
+
+    if get_quote_stream() is not None:
+        # 串流模式：卡片每秒以推播報價重畫，不重跑整頁
+        cards_slot.empty()
+        render_stream_market_cards(markets)
+    else:
+        cards_slot.markdown(_market_cards_html(markets), unsafe_allow_html=True)
+    render_swr_badge(get_global_market_data_with_chart)
     
     st.divider()
 
@@ -1161,82 +2826,150 @@ def render_global_markets():
             if hist['year']['score']: html_content += render_row("一年前", hist['year']['date'], hist['year']['score'])
             
             st.markdown(html_content, unsafe_allow_html=True)
+
+        # 歷史走勢：直接讀本地序列，不重新下載
+        fg_range = st.radio("歷史區間", list(FEAR_GREED_CHART_RANGES), index=2, horizontal=True, key="fg_history_range", label_visibility="collapsed")
+        days = FEAR_GREED_CHART_RANGES[fg_range]
+        since_ts = (datetime.now() - timedelta(days=days)).timestamp() * 1000 if days else None
+        fg_hist_df = get_fear_greed_history().series(since_ts)
+        if not fg_hist_df.empty:
+            st.plotly_chart(plot_fear_greed_history(fg_hist_df), use_container_width=True, config={'displayModeBar': False})
     else:
         st.info("⏳ 正在連線至 CNN 伺服器，請稍候... (若長時間未顯示，請重新整理)")
+    render_swr_badge(get_cnn_fear_greed_full)
 
     st.divider()
 
 # --- 真實爬蟲排行 ---
-@st.cache_data(ttl=60) 
+YAHOO_RANK_HEADERS = {"User-Agent": "Mozilla/5.0", "Referer": "https://tw.stock.yahoo.com/"}
+YAHOO_RANK_PAGES = [
+    ("https://tw.stock.yahoo.com/rank/turnover?exchange=TAI", "上市"),
+    ("https://tw.stock.yahoo.com/rank/turnover?exchange=TWO", "上櫃")
+]
+
+@st.cache_resource
+def get_rank_fetch_executor():
+    # 每個排行頁一個 worker：下載與解析都在 worker 內，一頁在解析時另一頁還在下載
+    return ThreadPoolExecutor(max_workers=len(YAHOO_RANK_PAGES), thread_name_prefix="yahoo-rank")
+
+def _html_cell_text(el):
+    # 連續空白 (含換行、nbsp) 收成一個空格，例如 "2330\n  台積電" -> "2330 台積電"
+    return " ".join(el.text_content().split())
+
+def _find_yahoo_rank_table(html):
+    """
+    直接用 XPath 找表頭含「成交值」的那張表，只把這張表轉成 DataFrame；
+    頁面結構改變找不到時，退回整頁 pd.read_html 再逐張比對。
+    """
+    tree = lxml.html.fromstring(html)
+    tables = tree.xpath("//table[.//th[contains(., '成交值')]]")
+    if tables:
+        table = tables[0]
+        header = [_html_cell_text(th) for th in table.xpath(".//tr[th][1]/th")]
+        width = len(header)
+        rows = [[_html_cell_text(td) for td in tr.xpath("./td")] for tr in table.xpath(".//tr[td]")]
+        rows = [(r + [''] * width)[:width] for r in rows]
+        return pd.DataFrame(rows, columns=header)
+    for df in pd.read_html(io.StringIO(html)):
+        if any("成交值" in str(c) for c in df.columns):
+            return df
+    return None
+
+@functools.lru_cache(maxsize=1)
+def _rank_sector_lookup():
+    # 已知名稱 → 族群 (與 smart_get_code_and_sector 結果相同)，讓排行表可以整欄 map
+    keys = set(NAME_TO_CODE) | set(ALIAS_MAP) | set(FORCE_FIX_SECTOR) | set(MASTER_STOCK_DB)
+    return {k: smart_get_code_and_sector(k)[2] for k in keys}
+
+def _clean_number(col):
+    return pd.to_numeric(col.astype(str).str.replace(r"[^\d.]", "", regex=True), errors='coerce')
+
+def _parse_yahoo_rank_page(html, market):
+    """解析單一排行頁，清洗與族群分類都是整欄運算，筆數變多 (例如前 100 名) 時耗時幾乎不變"""
+    target_df = _find_yahoo_rank_table(html)
+    if target_df is None or target_df.empty: return pd.DataFrame()
+    cols = target_df.columns.tolist()
+    name_idx = next((i for i, c in enumerate(cols) if "股" in str(c) and "名" in str(c)), 1)
+    price_idx = next((i for i, c in enumerate(cols) if "價" in str(c)), 2)
+    turnover_idx = next((i for i, c in enumerate(cols) if "值" in str(c) or "金額" in str(c)), 6)
+    change_idx = next((i for i, c in enumerate(cols) if "幅" in str(c)), 4)
+
+    # 不指定分隔字元：連續空白視為一個 (pd.read_html 會把 "\n  " 收成兩個空格)
+    tokens = target_df.iloc[:, name_idx].astype(str).str.split()
+    code = tokens.str[0]
+    name = tokens.str[1].fillna(code)
+    change_str = target_df.iloc[:, change_idx].astype(str)
+    change = _clean_number(change_str)
+    change = change.where(~change_str.str.contains("▼|-", regex=True), -change)
+
+    out = pd.DataFrame({
+        "代號": code, "名稱": name,
+        "股價": _clean_number(target_df.iloc[:, price_idx]),
+        "漲跌幅%": change,
+        "成交值(億)": _clean_number(target_df.iloc[:, turnover_idx]),
+        "市場": market,
+    }).dropna(subset=["股價", "成交值(億)", "漲跌幅%"])
+    get_exchange_resolver().learn_markets(out.loc[out["代號"].str.isdigit(), "代號"], market)
+    out = out[out["成交值(億)"] > 0].copy()
+    # 族群：已知名稱整欄查表，查不到的 (少數) 才逐一判斷
+    sector = out["名稱"].map(_rank_sector_lookup())
+    missing = sector.isna()
+    if missing.any():
+        sector[missing] = out.loc[missing, "名稱"].map(lambda n: smart_get_code_and_sector(n)[2])
+    out["族群"] = sector
+    out["來源"] = "Yahoo"
+    return out
+
+def _fetch_yahoo_rank_page(url, market):
+    """下載並解析單一排行頁 (失敗回傳空 DataFrame)"""
+    r = get_http_client().get(url, headers=YAHOO_RANK_HEADERS, timeout=10)
+    if r.status_code != 200: return pd.DataFrame()
+    return _parse_yahoo_rank_page(r.text, market)
+
+@swr_cache(ttl=MarketSessionTTL(60))
 def get_yahoo_realtime_rank(limit=20):
+    breaker = get_breaker("yahoo_rank")
     try:
-        headers = {"User-Agent": "Mozilla/5.0", "Referer": "https://tw.stock.yahoo.com/"}
-        urls = [
-            ("https://tw.stock.yahoo.com/rank/turnover?exchange=TAI", "上市"),
-            ("https://tw.stock.yahoo.com/rank/turnover?exchange=TWO", "上櫃")
-        ]
-        all_data = []
-        for url, market in urls:
-            r = requests.get(url, headers=headers, timeout=10)
-            if r.status_code == 200:
-                dfs = pd.read_html(io.StringIO(r.text))
-                target_df = None
-                for df in dfs:
-                    if any("成交值" in str(c) for c in df.columns):
-                        target_df = df
-                        break
-                if target_df is not None:
-                    cols = target_df.columns.tolist()
-                    name_idx = next((i for i, c in enumerate(cols) if "股" in str(c) and "名" in str(c)), 1)
-                    price_idx = next((i for i, c in enumerate(cols) if "價" in str(c)), 2)
-                    turnover_idx = next((i for i, c in enumerate(cols) if "值" in str(c) or "金額" in str(c)), 6)
-                    change_idx = next((i for i, c in enumerate(cols) if "幅" in str(c)), 4)
-                    for idx, row in target_df.iterrows():
-                        try:
-                            raw_str = str(row.iloc[name_idx])
-                            tokens = raw_str.split(' ')
-                            code = tokens[0]
-                            name = tokens[1] if len(tokens) > 1 else code
-                            _, _, sector = smart_get_code_and_sector(name)
-                            price = float(re.sub(r"[^\d.]", "", str(row.iloc[price_idx])))
-                            turnover = float(re.sub(r"[^\d.]", "", str(row.iloc[turnover_idx])))
-                            change_str = str(row.iloc[change_idx])
-                            if "▼" in change_str or "-" in change_str: change = -abs(float(re.sub(r"[^\d.]", "", change_str)))
-                            else: change = abs(float(re.sub(r"[^\d.]", "", change_str)))
-                            if turnover > 0:
-                                all_data.append({"代號": code, "名稱": name, "股價": price, "漲跌幅%": change, "成交值(億)": turnover, "市場": market, "族群": sector, "來源": "Yahoo"})
-                        except: continue
-        if all_data:
-            df = pd.DataFrame(all_data)
+        # 爬蟲斷路中直接改用 yfinance 備援
+        if not breaker.allow(): raise RuntimeError("yahoo rank circuit open")
+        # 所有排行頁同時下載，只等一個 round trip
+        executor = get_rank_fetch_executor()
+        futures = [executor.submit(_fetch_yahoo_rank_page, url, market) for url, market in YAHOO_RANK_PAGES]
+        pages = []
+        for fut in futures:
+            try:
+                pages.append(fut.result())
+            except Exception as e:
+                print(f"Yahoo Rank Page Error: {e}")
+        get_exchange_resolver().flush()
+        pages = [p for p in pages if not p.empty]
+        breaker.record(bool(pages))
+        if pages:
+            df = pd.concat(pages, ignore_index=True)
             df = df.sort_values(by="成交值(億)", ascending=False).reset_index(drop=True)
             df.index = df.index + 1
             df.insert(0, '排名', df.index)
             return df.head(limit)
     except: pass
     
-    # 備援：yfinance (V139 保底)
-    tickers = [f"{c}.TW" for c in MASTER_STOCK_DB.keys()] + [f"{c}.TWO" for c in MASTER_STOCK_DB.keys()]
+    # 備援：yfinance (V139 保底)，每個代號只抓已知交易所的 ticker
+    resolver = get_exchange_resolver()
     try:
-        data = yf.download(tickers, period="1d", group_by='ticker', progress=False, threads=False)
+        # 分塊並行下載，部分 ticker 被限流時只重試那些 ticker；猜錯交易所的同一次補抓另一個
+        bars, _ = fetch_with_exchange_fallback(
+            resolver, resolver.candidates(MASTER_STOCK_DB),
+            lambda ts: dict(tuple(download_bars(ts, period="1d").groupby('ticker'))))
+        if not bars: return pd.DataFrame()
+        bars = pd.concat(bars.values(), ignore_index=True)
+        latest = bars.sort_values('Date').groupby('ticker').tail(1)
+        latest = latest[(latest['Close'] > 0) & latest['Volume'].notna()]
+        latest = latest.assign(turnover=latest['Close'] * latest['Volume'] / 100000000)
+        latest = latest[latest['turnover'] >= 1]
         yf_list = []
-        for ticker in tickers:
+        for row in latest.itertuples(index=False):
             try:
+                ticker, price, turnover, op = row.ticker, row.Close, row.turnover, row.Open
                 code = re.sub(r"\D", "", ticker)
-                if isinstance(data.columns, pd.MultiIndex):
-                    if ticker not in data.columns.levels[0]: continue
-                    df_stock = data[ticker]
-                else:
-                    if len(tickers) == 1: df_stock = data
-                    else: continue
-                
-                if df_stock.empty: continue
-                latest = df_stock.iloc[-1]
-                price = latest['Close']
-                volume = latest['Volume']
-                if pd.isna(price) or pd.isna(volume) or price <= 0: continue
-                turnover = (price * volume) / 100000000
-                if turnover < 1: continue 
-                op = latest['Open']
                 chg = ((price - op)/op)*100 if op > 0 else 0
                 _, name, sector = smart_get_code_and_sector(code)
                 market = "上櫃" if ".TWO" in ticker else "上市"
@@ -1249,6 +2982,8 @@ def get_yahoo_realtime_rank(limit=20):
             df.insert(0, '排名', df.index)
             return df.head(limit)
     except: pass
+    finally:
+        resolver.flush()
     return pd.DataFrame()
 
 def plot_market_index(index_type='上市', period='6mo'):
@@ -1262,8 +2997,9 @@ def plot_market_index(index_type='上市', period='6mo'):
     ticker = ticker_map.get(index_type, '^TWII')
     
     try:
-        stock = yf.Ticker(ticker)
-        df = stock.history(period=period)
+        # 本地日K資料庫：切換週期或重新整理只會補抓最新的 K 棒
+        start = pd.Timestamp(_tw_today()) - pd.DateOffset(months=PERIOD_MONTHS.get(period, 6))
+        df = get_daily_bar_store().get_bars([ticker], start)[ticker]
         if df.empty: return None, f"無法取得 {index_type} 指數資料"
         
         # 計算均線
@@ -1335,51 +3071,44 @@ def render_trend_card(col, title, desc, bg_class, icon):
     </div>
     """, unsafe_allow_html=True)
 
-def render_stock_tags_v113(stock_str, turnover_map):
+def render_stock_tags_v113(stock_str, turnover_map, live=None):
     if pd.isna(stock_str) or not stock_str: return "<span style='color:#bdc3c7; font-size:1.2rem; font-weight:600;'>（無標的）</span>"
     stock_names = [s.strip() for s in str(stock_str).split('、') if s.strip()]
     html = ""
     for s in stock_names:
         clean_s = s.replace("(CB)", "").replace("*", "")
         t_str = ""
-        # 1. 查名稱
-        if clean_s in turnover_map:
-            t_str = f"<span class='turnover-val'>💰 {turnover_map[clean_s]:.1f}億</span>"
-        else:
-            # 2. 查代碼
+        # 1. 查名稱，2. 查代碼
+        val = turnover_map.get(clean_s)
+        # 串流推播的成交值 (以代號為 key) 優先
+        if live or val is None:
             code = smart_get_code(clean_s)
-            if code and code in turnover_map:
-                 t_str = f"<span class='turnover-val'>💰 {turnover_map[code]:.1f}億</span>"
+            if code and live and code in live: val = live[code]
+            elif val is None and code: val = turnover_map.get(code)
+        if val is not None:
+            # 還在背景救援中的先顯示 ⏳，下次重新整理補上
+            t_str = "<span class='turnover-val'>💰 ⏳</span>" if is_turnover_pending(val) else f"<span class='turnover-val'>💰 {val:.1f}億</span>"
         
         if "(CB)" in s: html += f"<div class='stock-tag stock-tag-cb'>{clean_s}<span class='cb-badge'>CB</span>{t_str}</div>"
         else: html += f"<div class='stock-tag'>{clean_s}{t_str}</div>"
     return html
 
 # --- 修改後的 load_db: 改從 Google Sheet 讀取 ---
-def load_db():
+def load_db(raw_df=None):
     # 1. 定義要讀取的分頁名稱
     target_sheet = "Daily_Main" 
     
     try:
-        # 呼叫通用讀取函式
-        df = load_data_from_gsheet(target_sheet)
+        # 呼叫通用讀取函式 (儀表板會直接傳入批次讀取好的資料)
+        df = load_data_from_gsheet(target_sheet) if raw_df is None else raw_df
         
         if not df.empty:
-            # 資料處理邏輯...
-            if 'date' in df.columns:
-                df['date'] = pd.to_datetime(df['date'], errors='coerce').dt.strftime('%Y-%m-%d')
-            
-            # 確保數值欄位正確
-            numeric_cols = ['part_time_count', 'worker_strong_count', 'worker_trend_count']
-            for col in numeric_cols:
-                if col in df.columns:
-                    df[col] = pd.to_numeric(df[col], errors='coerce').fillna(0).astype(int)
-            
+            # 日期解析、數值欄位 (int32)、排序都已在讀取時依 SHEET_SCHEMAS 完成
             if 'manual_turnover' not in df.columns:
                 df['manual_turnover'] = ""
             df['manual_turnover'] = df['manual_turnover'].astype(str).replace('nan', '')
 
-            return df.sort_values('date', ascending=False)
+            return df
             
         return pd.DataFrame()
 
@@ -1405,44 +3134,28 @@ def load_history_data(file_path=HISTORY_FILE_TPEX):
             print(f"Load History Error ({file_path}): {e}")
     return pd.DataFrame()
 
-# --- 修改後的 save_batch_data: 寫入 Google Sheet ---
+# --- 修改後的 save_batch_data: 以日期 upsert 寫入 Google Sheet ---
 def save_batch_data(records_list):
-    # 1. 先讀取目前雲端上的最新資料
-    current_df = load_db()
-    
-    # 2. 準備要寫入的新資料
+    # 1. 準備要寫入的新資料 (不再先下載整個 Daily_Main)
     if isinstance(records_list, list): 
         new_data = pd.DataFrame(records_list)
     else: 
-        new_data = records_list
+        new_data = records_list.copy()
     
     if not new_data.empty:
         new_data['date'] = pd.to_datetime(new_data['date'], errors='coerce').dt.strftime('%Y-%m-%d')
+        # 沒有日期就無法定位列號，同一天重複只保留最後一筆
+        new_data = new_data.dropna(subset=['date']).drop_duplicates('date', keep='last')
         if 'manual_turnover' not in new_data.columns:
             new_data['manual_turnover'] = ""
-            
-        # 3. 合併邏輯 (Merge)
-        if not current_df.empty:
-            # 移除舊資料中，日期與新資料重複的部分 (避免重複)
-            current_df = current_df[~current_df['date'].isin(new_data['date'])]
-            # 合併
-            final_df = pd.concat([current_df, new_data], ignore_index=True)
-        else: 
-            final_df = new_data
-            
-        # 4. 排序 (新到舊)
-        final_df = final_df.sort_values('date', ascending=False)
-        
-        # 5. 寫入 Google Sheet
-        # 使用我們之前寫好的通用寫入函式
-        ok, msg = save_data_to_gsheet(final_df, "Daily_Main")
+
+        # 2. 已存在的日期覆寫該列、新日期插入對應位置 (新到舊)
+        ok, msg = upsert_rows_by_key(new_data, "Daily_Main", key_col='date')
         
         if not ok:
             st.error(msg)
             
-        return final_df
-        
-    return current_df
+    return new_data
 
 # --- 修改後的 save_full_history: 寫入 Google Sheet ---
 def save_full_history(df_to_save):
@@ -1459,16 +3172,14 @@ def save_full_history(df_to_save):
 # --- 修改後的 clear_db: 清空 Google Sheet ---
 def clear_db():
     try:
-        client = get_gsheet_connection()
-        sheet = client.open(st.secrets["sheet_name"])
-        ws = sheet.worksheet("Daily_Main")
+        ws = get_gsheet_manager().get_worksheet("Daily_Main")
         ws.clear()
         # 建議保留標題列，避免下次讀取報錯，所以清空後寫回標題
         headers = ['date', 'wind', 'part_time_count', 'worker_strong_count', 'worker_trend_count', 
                    'worker_strong_list', 'worker_trend_list', 'boss_pullback_list', 
                    'boss_bargain_list', 'top_revenue_list', 'last_updated', 'manual_turnover']
         ws.append_row(headers)
-        load_data_from_gsheet.clear() # 清除快取
+        _remember_written_grid("Daily_Main", [headers]) # 版本號 +1 等同清除該分頁快取
     except Exception as e:
         st.error(f"清空失敗: {e}")
 
@@ -1746,30 +3457,37 @@ def ai_analyze_v86(image):
 
 
 # --- [V2.3] 超強壯指數獲取 (官方API -> YF Fast -> YF 1分K -> YF 日K) ---
-def get_index_live_data(symbol, official_key=None):
+def get_index_live_data(symbol, official_key=None, snapshot=None):
     """
     通用指數抓取函式，支援櫃買(^TWOII)與加權(^TWII)。
     優先順序: 官方MIS -> YF FastInfo -> YF 1分K(即時) -> YF 日K(昨收)
+    傳入 snapshot (MarketSnapshot) 時，官方報價沿用本輪 render 已抓到的結果。
     """
-    # 預設回傳
-    result = {'price': 0.0, 'change': 0.0, 'pct_change': 0.0}
-    
     # 1. 優先嘗試官方 API (最準，但雲端易被擋)
     if official_key:
         try:
-            official_data = fetch_official_tw_index_data()
+            official_data = snapshot.tw_official() if snapshot else fetch_official_tw_index_data()
             if official_key in official_data:
                 data = official_data[official_key]
                 if data['price'] > 0:
                     return data
         except Exception: pass
 
-    # 2. Yahoo Finance 救援機制
+    # 2. Yahoo Finance 救援機制 (依交易時段快取)
+    return _get_index_yf_quote(symbol)
+
+@swr_cache(ttl=MarketSessionTTL(60), is_valid=lambda v: v['price'] > 0)
+def _get_index_yf_quote(symbol):
+    result = {'price': 0.0, 'change': 0.0, 'pct_change': 0.0}
+    breaker = get_breaker("yf_history")
+    if not breaker.allow(): return result
     try:
         ticker = yf.Ticker(symbol)
         
         # 步驟 A: 嘗試取得「日K」(Daily) 判斷趨勢
+        yf_throttle()
         df_daily = ticker.history(period="5d")
+        breaker.record(not df_daily.empty)
         
         if not df_daily.empty:
             # 取得日線最後一筆
@@ -1790,6 +3508,7 @@ def get_index_live_data(symbol, official_key=None):
             
             # 步驟 B: 嘗試抓「1分K」補救即時價格 (只抓最近 1 天)
             try:
+                yf_throttle()
                 df_intra = ticker.history(period="1d", interval="1m")
                 if not df_intra.empty:
                     real_time_price = float(df_intra['Close'].iloc[-1])
@@ -1816,13 +3535,14 @@ def get_index_live_data(symbol, official_key=None):
                 return {'price': final_price, 'change': change, 'pct_change': pct_change}
             
     except Exception as e:
+        breaker.record(False)
         print(f"Index Fallback Error ({symbol}): {e}")
 
     return result
 
 # ---計算指定月份的個股平均成交值
 
-@st.cache_data(ttl=300)
+@swr_cache(ttl=MarketSessionTTL(300))
 def get_monthly_avg_turnover(stock_names, month_str):
     """
     計算指定月份的個股平均成交值
@@ -1848,37 +3568,32 @@ def get_monthly_avg_turnover(stock_names, month_str):
 
     # 2. 轉換名稱為代碼
     code_map = {} # {code: name}
-    tickers = []
     unique_names = list(set(stock_names))
     
     for name in unique_names:
         # 假設 smart_get_code_and_sector 已經在您的程式碼中定義
         code, _, _ = smart_get_code_and_sector(name)
         if code:
-            tickers.append(f"{code}.TW")
-            tickers.append(f"{code}.TWO")
             code_map[code] = name # 用代碼反查名稱
 
-    if not tickers: return {}
+    # 只下載已知交易所的那一個 ticker (未知的才兩個都試)
+    resolver = get_exchange_resolver()
+    candidates = resolver.candidates(code_map)
+    if not candidates: return {}
 
-    # 3. 批次下載歷史資料 (加速)
+    # 3. 從本地日K資料庫讀取 (只補抓缺少的日期；end_date 為下個月第一天，不含；猜錯交易所的同一次補抓另一個)
     try:
-        data = yf.download(tickers, start=start_date, end=end_date, group_by='ticker', progress=False, threads=False)
+        store = get_daily_bar_store()
+        last_day = pd.Timestamp(end_date) - timedelta(days=1)
+        bars, candidates = fetch_with_exchange_fallback(resolver, candidates, lambda ts: store.get_bars(ts, start_date, last_day))
         result = {}
         
         for code, name in code_map.items():
             avg_val = 0
-            # 嘗試上市或上櫃
-            for suffix in ['.TW', '.TWO']:
-                ticker = f"{code}{suffix}"
+            # 已知交易所只會有一個 ticker；未知的上市/上櫃都試
+            for ticker in candidates[code]:
                 try:
-                    if isinstance(data.columns, pd.MultiIndex) and ticker in data.columns.levels[0]:
-                        df = data[ticker]
-                    elif len(tickers) == 1: # 只有一檔時 yfinance 結構不同
-                        df = data
-                    else:
-                        continue
-
+                    df = bars[ticker]
                     if not df.empty:
                         # 計算每日成交值 = 收盤價 * 成交量 / 1億
                         # 處理可能的 NaN
@@ -1899,6 +3614,8 @@ def get_monthly_avg_turnover(stock_names, month_str):
     except Exception as e:
         print(f"Error fetching monthly turnover: {e}")
         return {}
+    finally:
+        resolver.flush()
 
 # --- 【新增】共用的循環分析渲染函式 ---
 def render_cycle_analysis_ui(hist_df, index_name="上櫃指數"):
@@ -2074,8 +3791,310 @@ def render_cycle_analysis_ui(hist_df, index_name="上櫃指數"):
 
 
 # --- 5. 頁面視圖：戰情儀表板 (修正 KeyError: wind 版) ---
+def render_wind_gauge(wind_args, taiex_info, tpex_info):
+    # wind_args: 加權 (風度, 連續天數, 乖離率, 前日風度) + 櫃買 (同上)
+    gauge_fig = plot_wind_gauge_bias_driven(*wind_args, taiex_info, tpex_info)
+    
+    st.markdown('<div style="background-color:#1a1a1a; border-radius:20px; padding:10px; box-shadow:0 8px 16px rgba(0,0,0,0.2);">', unsafe_allow_html=True)
+    st.plotly_chart(gauge_fig, use_container_width=True, height=420, config={'displayModeBar': False, 'responsive': True}, key="main_gauge")
+    st.markdown('</div>', unsafe_allow_html=True)
+
+def render_strategy_tags(day_data, turnover_map, live=None):
+    st.markdown('<div class="strategy-banner worker-banner"><p class="banner-text">👨‍💼 上班族策略 (Worker Strategy)</p></div>', unsafe_allow_html=True)
+    w1, w2 = st.columns(2)
+    with w1: st.markdown("### 🚀 強勢週 TOP 3"); st.markdown(render_stock_tags_v113(day_data['worker_strong_list'], turnover_map, live), unsafe_allow_html=True)
+    with w2: st.markdown("### 📈 週趨勢"); st.markdown(render_stock_tags_v113(day_data['worker_trend_list'], turnover_map, live), unsafe_allow_html=True)
+
+    st.markdown('<div class="strategy-banner boss-banner"><p class="banner-text">👑 老闆策略 (Boss Strategy)</p></div>', unsafe_allow_html=True)
+    b1, b2 = st.columns(2)
+    with b1: st.markdown("### ↩️ 週拉回"); st.markdown(render_stock_tags_v113(day_data['boss_pullback_list'], turnover_map, live), unsafe_allow_html=True)
+    with b2: st.markdown("### 🏷️ 廉價收購"); st.markdown(render_stock_tags_v113(day_data['boss_bargain_list'], turnover_map, live), unsafe_allow_html=True)
+
+    st.markdown('<div class="strategy-banner revenue-banner"><p class="banner-text">💰 營收創高 (TOP 6)</p></div>', unsafe_allow_html=True)
+    st.markdown(render_stock_tags_v113(day_data['top_revenue_list'], turnover_map, live), unsafe_allow_html=True)
+
+# --- 共用報價輪詢 (每個 Server 一條 thread，所有 Session 讀同一份快照) ---
+# 在快取到期前就先更新並發布快照；不管多少人在看，上游請求量都固定
+QUOTE_POLL_TICK_SEC = 5
+QUOTE_POLL_LEAD_SEC = 5 # 到期前幾秒就先更新
+QUOTE_POLL_IDLE_SEC = 1800 # 超過這麼久沒人看儀表板就暫停例行輪詢 (開盤前預熱照常)
+QUOTE_WATCH_TTL_SEC = 600 # Session 登記的股票清單多久沒再出現就不再輪詢
+QUOTE_SNAPSHOT_MAX_AGE_SEC = 60 # 快照超過這麼久沒被 poller 檢查 (閒置中)，畫面不使用它
+PRE_OPEN_WARMUP = (8, 55) # 開盤前強制預熱 (Asia/Taipei)
+LIVE_INDEX_SYMBOLS = ("^TWII", "^TWOII")
+
+def _dashboard_poll_jobs():
+    return [
+        (get_global_market_data_with_chart, ()),
+        (fetch_official_tw_index_data, ()),
+        (_get_index_yf_quote, ("^TWII",)),
+        (_get_index_yf_quote, ("^TWOII",)),
+        (get_yahoo_realtime_rank, (20,)),
+        (get_cnn_fear_greed_full, ()),
+    ]
+
+class QuotePoller:
+    """
+    唯一擁有即時報價的輪詢器：依各快取自己的期限 (固定秒數或交易時段) 在到期前更新，
+    每輪把指數、全球卡片與 Session 登記的策略選股成交值整理成一份快照發布 (附 checked_at)。
+    每天開盤前另外強制預熱一次。
+    """
+    def __init__(self, jobs):
+        self.jobs = jobs
+        self.last_visit = time.time()
+        self._lock = threading.Lock()
+        self._watches = {} # {key: (fetcher, args, 最後登記時間)}
+        self._snapshot = {}
+        self._last_warmup = None
+        self._thread = threading.Thread(target=self._loop, name="quote-poller", daemon=True)
+        self._thread.start()
+
+    def touch(self):
+        self.last_visit = time.time()
+
+    def latest(self):
+        with self._lock:
+            return self._snapshot
+
+    def watch(self, fetcher, args):
+        """登記要持續更新的資料 (例如今天的策略選股成交值)，回傳它在快照 'watched' 裡的 key"""
+        key = repr(args)
+        with self._lock:
+            self._watches[key] = (fetcher, args, time.time())
+        return key
+
+    def _active_watches(self):
+        now = time.time()
+        with self._lock:
+            for key in [k for k, (_, _, seen) in self._watches.items() if now - seen > QUOTE_WATCH_TTL_SEC]:
+                del self._watches[key]
+            return {key: (fetcher, args) for key, (fetcher, args, _) in self._watches.items()}
+
+    def _pre_open_warmup(self):
+        # 強制更新所有行情，並把指數日K補到最新 (走勢圖、自動更新歷史會用到)
+        for fetcher, args in self.jobs:
+            fetcher.refresh(*args)
+        start = pd.Timestamp(_tw_today()) - pd.DateOffset(months=PERIOD_MONTHS['6mo'])
+        get_daily_bar_store().get_bars(list(LIVE_INDEX_SYMBOLS), start)
+
+    def _publish(self, watches, stream=None):
+        # 串流正常時指數直接取推播報價，不再經過會觸發背景更新的 get_index_live_data
+        live = {symbol: stream.quote(symbol) for symbol in LIVE_INDEX_SYMBOLS} if stream is not None else {}
+        payload = {
+            'cards': get_global_market_data_with_chart.peek(),
+            'tw_official': fetch_official_tw_index_data.peek(),
+            'index': {symbol: live.get(symbol) or get_index_live_data(symbol, symbol) for symbol in LIVE_INDEX_SYMBOLS},
+            'watched': {key: fetcher.peek(*args) for key, (fetcher, args) in watches.items()},
+        }
+        with self._lock:
+            # checked_at 每輪都更新，畫面用它判斷 poller 是否閒置 (快照太舊就不用)
+            self._snapshot = {**payload, 'checked_at': time.time()}
+
+    def _tick(self):
+        now = datetime.now(pytz.timezone('Asia/Taipei'))
+        hm = (now.hour, now.minute)
+        if now.weekday() < 5 and PRE_OPEN_WARMUP <= hm < TW_SESSION_OPEN and self._last_warmup != now.date():
+            self._last_warmup = now.date()
+            self._pre_open_warmup()
+        if time.time() - self.last_visit > QUOTE_POLL_IDLE_SEC: return
+        watches = self._active_watches()
+        stream = get_quote_stream()
+        skipped = _stream_covered_fetchers() if stream is not None and stream.is_live() else ()
+        for fetcher, args in [*self.jobs, *watches.values()]:
+            if fetcher in skipped: continue
+            remaining = fetcher.expires_in(*args)
+            if remaining is None or remaining < QUOTE_POLL_LEAD_SEC:
+                fetcher.refresh(*args)
+        self._publish(watches, stream if skipped else None)
+
+    def _loop(self):
+        while True:
+            try:
+                self._tick()
+            except Exception as e:
+                print(f"Quote Poller Error: {e}")
+            time.sleep(QUOTE_POLL_TICK_SEC)
+
+@st.cache_resource
+def get_quote_poller():
+    return QuotePoller(_dashboard_poll_jobs())
+
+# --- 即時報價串流 (選用)：每個 Server 一條 SSE 長連線，畫面用 fragment 每秒讀記憶體 ---
+# secrets 設定 [quote_stream]：
+#   url = "https://.../stream"        上游 SSE 端點
+#   replay_file = "ticks.jsonl"       或改用本地重播伺服器 (測試/展示用)，可再設 replay_speed
+# 事件格式 (data: 後接一個 JSON)：
+#   指數/卡片 {"symbol": "^TWII", "price": 23001.5, "change": 12.3, "pct_change": 0.05}
+#   個股成交值 {"symbol": "2330", "turnover": 123.4}  (單位：億)
+QUOTE_STREAM_REFRESH_SEC = 1 # fragment 重畫間隔
+QUOTE_STREAM_READ_TIMEOUT = 30 # 這麼久沒收到任何資料 (含 heartbeat) 就重連
+QUOTE_STREAM_STALE_SEC = 60 # 超過這麼久沒有事件，視為串流中斷，poller 恢復輪詢
+QUOTE_TICK_FIELDS = ('price', 'change', 'pct_change', 'turnover')
+
+class QuoteStream:
+    """
+    接收上游推播的逐筆報價，依 symbol 保存最新值。
+    斷線時以 jitter 指數退避重連；串流正常時 QuotePoller 不再輪詢它涵蓋的報價。
+    """
+    def __init__(self, url):
+        self.url = url
+        self._lock = threading.Lock()
+        self._ticks = {}
+        self.connected = False
+        self.last_event_at = None
+        self._thread = threading.Thread(target=self._loop, name="quote-stream", daemon=True)
+        self._thread.start()
+
+    def is_live(self):
+        return self.connected and self.last_event_at is not None and time.time() - self.last_event_at < QUOTE_STREAM_STALE_SEC
+
+    def quotes(self):
+        """{symbol: {price, change, pct_change}}，格式與 MIS 官方報價相同"""
+        with self._lock:
+            return {sym: t for sym, t in self._ticks.items() if 'price' in t}
+
+    def quote(self, symbol, fallback=None):
+        with self._lock:
+            tick = self._ticks.get(symbol)
+        return {**(fallback or {}), **tick} if tick and 'price' in tick else fallback
+
+    def turnovers(self):
+        """{股票代號: 成交值(億)}"""
+        with self._lock:
+            return {sym: t['turnover'] for sym, t in self._ticks.items() if 'turnover' in t}
+
+    def _apply(self, event):
+        symbol = event.get('symbol')
+        fields = {k: float(event[k]) for k in QUOTE_TICK_FIELDS if event.get(k) is not None}
+        if not symbol or not fields: return
+        with self._lock:
+            # 每次換成新的 dict，讀取端拿到的舊 dict 不會被改動
+            self._ticks[symbol] = {**self._ticks.get(symbol, {}), **fields}
+
+    def _consume(self):
+        r = get_http_client().get(self.url, headers={"Accept": "text/event-stream"}, timeout=(5, QUOTE_STREAM_READ_TIMEOUT), retries=0, stream=True)
+        with r:
+            if r.status_code != 200: raise RuntimeError(f"HTTP {r.status_code}")
+            r.encoding = 'utf-8'
+            self.connected = True
+            data = []
+            for line in r.iter_lines(decode_unicode=True):
+                self.last_event_at = time.time()
+                if not line:
+                    # 空行 = 一個事件結束
+                    if data:
+                        try: self._apply(json.loads("\n".join(data)))
+                        except (ValueError, TypeError) as e: print(f"Quote Stream Bad Event: {e}")
+                    data = []
+                elif line.startswith('data:'):
+                    data.append(line[5:].lstrip())
+                # ':' 開頭為 heartbeat 註解，event:/id: 不使用
+
+    def _loop(self):
+        attempt = 0
+        while True:
+            started = time.time()
+            try:
+                self._consume()
+            except Exception as e:
+                print(f"Quote Stream Error: {e}")
+            self.connected = False
+            # 連線撐過一段時間才斷，視為正常斷線，退避從頭算
+            attempt = 0 if time.time() - started > QUOTE_STREAM_STALE_SEC else attempt + 1
+            time.sleep(min(60, 2 ** attempt) * random.uniform(0.5, 1.5))
+
+class _QuoteReplayHandler(BaseHTTPRequestHandler):
+    def do_GET(self):
+        self.send_response(200)
+        self.send_header("Content-Type", "text/event-stream")
+        self.send_header("Cache-Control", "no-cache")
+        self.end_headers()
+        events, speed = self.server.events, self.server.speed
+        try:
+            while True: # 播完從頭再播
+                last_t = 0.0
+                for t, payload in events:
+                    time.sleep(max(0.0, t - last_t) / speed)
+                    last_t = t
+                    self.wfile.write(f"data: {payload}\n\n".encode('utf-8'))
+                    self.wfile.flush()
+                self.wfile.write(b": replay loop\n\n")
+                self.wfile.flush()
+                time.sleep(1) # 每輪之間停一下，避免全部 t=0 時空轉
+        except (BrokenPipeError, ConnectionResetError):
+            return
+
+    def log_message(self, format, *args):
+        pass # 不把每個連線印到 console
+
+def start_quote_replay_server(replay_file, speed=1.0):
+    """
+    本地 SSE 重播伺服器，取代真正的串流來源做測試。
+    replay_file 每行一筆 JSON，"t" 為相對於開始的秒數，其餘欄位即事件內容。回傳串流網址。
+    """
+    events = []
+    with open(replay_file, encoding='utf-8') as f:
+        for line in f:
+            if not line.strip(): continue
+            tick = json.loads(line)
+            events.append((float(tick.pop('t', 0)), json.dumps(tick, ensure_ascii=False)))
+    events.sort(key=lambda e: e[0])
+    server = ThreadingHTTPServer(("127.0.0.1", 0), _QuoteReplayHandler)
+    server.daemon_threads = True
+    server.events, server.speed = events, float(speed)
+    threading.Thread(target=server.serve_forever, name="quote-replay", daemon=True).start()
+    return f"http://127.0.0.1:{server.server_address[1]}/stream"
+
+def _quote_stream_config():
+    try: return dict(st.secrets.get("quote_stream", {}))
+    except Exception: return {} # 沒有 secrets 檔
+
+@st.cache_resource
+def get_quote_stream():
+    """沒有設定 [quote_stream] 時回傳 None (維持輪詢模式)"""
+    cfg = _quote_stream_config()
+    if cfg.get('replay_file'):
+        return QuoteStream(start_quote_replay_server(cfg['replay_file'], cfg.get('replay_speed', 1.0)))
+    if cfg.get('url'):
+        return QuoteStream(cfg['url'])
+    return None
+
+def _stream_covered_fetchers():
+    # 串流正常時不必輪詢的報價來源：只有兩個台股指數。
+    # 全球卡片的走勢圖不在串流內；策略選股成交值串流不一定每檔都推，照常輪詢，推播值在畫面上優先
+    return (fetch_official_tw_index_data, _get_index_yf_quote)
+
+def render_stream_status(stream):
+    if stream.is_live():
+        st.caption(f"⚡ 即時串流 · {datetime.fromtimestamp(stream.last_event_at, pytz.timezone('Asia/Taipei')).strftime('%H:%M:%S')}")
+    else:
+        st.caption("⏳ 即時串流重新連線中...")
+
+@st.fragment(run_every=QUOTE_STREAM_REFRESH_SEC)
+def render_stream_market_cards(markets):
+    stream = get_quote_stream()
+    st.markdown(_market_cards_html(_apply_official_quotes(copy.deepcopy(markets), stream.quotes())), unsafe_allow_html=True)
+    render_stream_status(stream)
+
+@st.fragment(run_every=QUOTE_STREAM_REFRESH_SEC)
+def render_stream_wind_gauge(wind_args, taiex_info, tpex_info):
+    stream = get_quote_stream()
+    render_wind_gauge(wind_args, stream.quote("^TWII", taiex_info), stream.quote("^TWOII", tpex_info))
+
+@st.fragment(run_every=QUOTE_STREAM_REFRESH_SEC)
+def render_stream_strategy_tags(day_data, turnover_map, manual_json=None):
+    # 管理員手動輸入的成交值是刻意覆寫的，串流推播不能蓋掉
+    manual = parse_manual_turnover(manual_json)
+    live = {code: val for code, val in get_quote_stream().turnovers().items() if code not in manual}
+    render_strategy_tags(day_data, turnover_map, live)
+
 def show_dashboard():
-    df = load_db()
+    poller = get_quote_poller()
+    poller.touch()
+
+    # 一次讀齊 Daily_Main / TAIEX / TPEx (同一個快照)
+    sheets = load_dashboard_sheets()
+    df = load_db(sheets["Daily_Main"])
     if df.empty:
         st.info("👋 目前無資料。請至後台新增。")
         return
@@ -2123,6 +4142,10 @@ def show_dashboard():
         return
     day_data = day_df.iloc[0]
 
+    # 本輪畫面共用的行情快照：讀 poller 發布的版本 (快照還沒有的才自己抓，MIS 只打一次)
+    market_snapshot = MarketSnapshot(poller.latest(), poller)
+    quote_stream = get_quote_stream()
+
     # --- 預先抓取成交值 ---
     turnover_map = {}
     with st.spinner("正在計算策略選股成交值..."):
@@ -2135,12 +4158,12 @@ def show_dashboard():
         ]
         manual_json = day_data.get('manual_turnover', None)
         if pd.isna(manual_json): manual_json = None
-        turnover_map = prefetch_turnover_data(all_strategy_stocks, selected_date, manual_override_json=manual_json)
+        turnover_map = market_snapshot.turnover(all_strategy_stocks, selected_date, manual_json)
 
     # --- 標題區塊 ---
     st.markdown(f"""<div class="title-box"><h1 style='margin:0; font-size: 2.8rem;'>📅 {selected_date} 風箏市場戰情室</h1><p style='margin-top:10px; opacity:0.9;'>資料更新於: {day_data['last_updated']}</p></div>""", unsafe_allow_html=True)
 
-    render_global_markets()
+    render_global_markets(market_snapshot)
 
     with st.expander("📊 大盤指數走勢圖 (點擊展開)", expanded=False):
         col_m1, col_m2 = st.columns([1, 4])
@@ -2158,11 +4181,11 @@ def show_dashboard():
     st.markdown("### 🌬️ 每日風度與風箏數")
 
     # 1. 抓取即時指數
-    tpex_info = get_index_live_data("^TWOII", "^TWOII")
-    taiex_info = get_index_live_data("^TWII", "^TWII")
+    tpex_info = market_snapshot.index_live("^TWOII", "^TWOII")
+    taiex_info = market_snapshot.index_live("^TWII", "^TWII")
 
     # 2. 準備加權指數資料 (含前日比較)
-    df_taiex = load_data_from_gsheet("TAIEX")
+    df_taiex = sheets["TAIEX"]
     taiex_w_status = "無資料"
     taiex_w_streak = 0
     taiex_w_bias = 0.0
@@ -2198,7 +4221,7 @@ def show_dashboard():
             taiex_prev_wind = taiex_w_status
 
     # 3. 準備櫃買指數資料 (含前日比較)
-    df_tpex = load_data_from_gsheet("TPEx")
+    df_tpex = sheets["TPEx"]
     tpex_w_status = "無資料"
     tpex_w_streak = 0
     tpex_w_bias = 0.0
@@ -2236,16 +4259,12 @@ def show_dashboard():
     col_gauge, col_cards = st.columns([4, 6], gap="large", vertical_alignment="center") 
     
     with col_gauge:
-        # 呼叫新的繪圖函式
-        gauge_fig = plot_wind_gauge_bias_driven(
+        wind_args = (
             taiex_w_status, taiex_w_streak, taiex_w_bias, taiex_prev_wind,
             tpex_w_status, tpex_w_streak, tpex_w_bias, tpex_prev_wind,
-            taiex_info, tpex_info
         )
-        
-        st.markdown('<div style="background-color:#1a1a1a; border-radius:20px; padding:10px; box-shadow:0 8px 16px rgba(0,0,0,0.2);">', unsafe_allow_html=True)
-        st.plotly_chart(gauge_fig, use_container_width=True, height=420, config={'displayModeBar': False, 'responsive': True}, key="main_gauge")
-        st.markdown('</div>', unsafe_allow_html=True)
+        if quote_stream is not None: render_stream_wind_gauge(wind_args, taiex_info, tpex_info)
+        else: render_wind_gauge(wind_args, taiex_info, tpex_info)
 
     with col_cards:
         st.markdown("""
@@ -2296,18 +4315,11 @@ def show_dashboard():
         """
         st.markdown(cards_html, unsafe_allow_html=True)
 
-    st.markdown('<div class="strategy-banner worker-banner"><p class="banner-text">👨‍💼 上班族策略 (Worker Strategy)</p></div>', unsafe_allow_html=True)
-    w1, w2 = st.columns(2)
-    with w1: st.markdown("### 🚀 強勢週 TOP 3"); st.markdown(render_stock_tags_v113(day_data['worker_strong_list'], turnover_map), unsafe_allow_html=True)
-    with w2: st.markdown("### 📈 週趨勢"); st.markdown(render_stock_tags_v113(day_data['worker_trend_list'], turnover_map), unsafe_allow_html=True)
-
-    st.markdown('<div class="strategy-banner boss-banner"><p class="banner-text">👑 老闆策略 (Boss Strategy)</p></div>', unsafe_allow_html=True)
-    b1, b2 = st.columns(2)
-    with b1: st.markdown("### ↩️ 週拉回"); st.markdown(render_stock_tags_v113(day_data['boss_pullback_list'], turnover_map), unsafe_allow_html=True)
-    with b2: st.markdown("### 🏷️ 廉價收購"); st.markdown(render_stock_tags_v113(day_data['boss_bargain_list'], turnover_map), unsafe_allow_html=True)
-
-    st.markdown('<div class="strategy-banner revenue-banner"><p class="banner-text">💰 營收創高 (TOP 6)</p></div>', unsafe_allow_html=True)
-    st.markdown(render_stock_tags_v113(day_data['top_revenue_list'], turnover_map), unsafe_allow_html=True)
+    # 串流只推今天的成交值，回顧歷史日期時照常顯示
+    if quote_stream is not None and selected_date == _tw_today().strftime('%Y-%m-%d'):
+        render_stream_strategy_tags(day_data, turnover_map, manual_json)
+    else:
+        render_strategy_tags(day_data, turnover_map)
 
     st.markdown("---")
     st.header("📊 市場數據趨勢分析")
@@ -2643,6 +4655,7 @@ def show_dashboard():
     
     with st.spinner("正在計算最新成交資料..."):
         rank_df = get_yahoo_realtime_rank(20)
+        render_swr_badge(get_yahoo_realtime_rank, 20)
         
         if isinstance(rank_df, pd.DataFrame) and not rank_df.empty:
             max_turnover = rank_df['成交值(億)'].max()
@@ -2682,6 +4695,8 @@ def show_admin_panel():
     # 檢查 API Key
     if not GOOGLE_API_KEY: st.error("❌ 未設定 API Key"); return
 
+    render_http_stats()
+
     # 定義四個分頁
     t1, t2, t3, t4 = st.tabs(["📈 櫃買歷史", "📊 加權歷史", "📥 新增每日資料", "📝 主資料庫編輯"])
     
@@ -2689,24 +4704,12 @@ def show_admin_panel():
 # === [防封鎖版] 子功能：自動更新歷史股價 ===
 def auto_update_index_history(df, ticker_symbol):
     try:
-        # 1. 偽裝成瀏覽器 (關鍵修改！)
-        session = requests.Session()
-        session.headers.update({
-            "User-Agent": "Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/120.0.0.0 Safari/537.36"
-        })
-
-        # 2. 使用 session 請求 yfinance
-        stock = yf.Ticker(ticker_symbol, session=session)
-        
-        # 3. 嘗試抓取資料 (加入重試機制)
-        hist = pd.DataFrame()
-        for i in range(3): # 最多試 3 次
-            try:
-                hist = stock.history(period="3mo")
-                if not hist.empty: break
-                time.sleep(1) # 休息一下再試
-            except: 
-                time.sleep(2)
+        # 1. 從本地日K資料庫讀近三個月 (已存過的日期不再下載，通常只補抓最新一根)
+        store = get_daily_bar_store()
+        start = pd.Timestamp(_tw_today()) - pd.DateOffset(months=3)
+        
+        # 2. 抓取資料 (限流排隊與失敗重試都在 download_bars 內處理)
+        hist = store.get_bars([ticker_symbol], start)[ticker_symbol]
         
         if hist.empty: return df, "❌ 無法取得 Yahoo 報價 (Rate Limit)，請稍後再試。"
         
@@ -2756,7 +4759,7 @@ def auto_update_index_history(df, ticker_symbol):
                 st.warning(f"⚠️ {sheet_name} 目前沒有資料或讀取失敗。")
                 st.info("💡 請確認：\n1. Google Sheet 是否已共用給機器人 Email？\n2. 該分頁的第一列是否已填入欄位名稱？(日期, 收, 風度, 20MA, 乖離率)")
                 if st.button(f"🔄 我已設定好，重新讀取 {sheet_name}"):
-                    load_data_from_gsheet.clear()
+                    invalidate_sheet(sheet_name)
                     st.rerun()
                 return
 
@@ -2771,6 +4774,7 @@ def auto_update_index_history(df, ticker_symbol):
                     else: st.warning(msg)
             
             # 編輯器
+            df = df.astype({c: object for c in df.select_dtypes(include='category').columns})
             edited = st.data_editor(df, num_rows="dynamic", use_container_width=True, key=f"ed_{sheet_name}", height=350)
             
             # 儲存按鈕
@@ -2874,6 +4878,8 @@ def auto_update_index_history(df, ticker_symbol):
             st.warning("⚠️ Daily_Main 目前沒有資料。請確認 Google Sheet 分頁名稱與第一列標題。")
             st.code("date, wind, part_time_count, worker_strong_count, worker_trend_count, worker_strong_list, worker_trend_list, boss_pullback_list, boss_bargain_list, top_revenue_list, last_updated, manual_turnover")
         else:
+            # category 欄位在編輯器裡會變成下拉選單，轉回字串才能自由輸入新的風度
+            df_main = df_main.astype({c: object for c in df_main.select_dtypes(include='category').columns})
             ed_main = st.data_editor(df_main, num_rows="dynamic", use_container_width=True, height=500)
             if st.button("💾 儲存主資料庫變更"):
                 ok, m = save_data_to_gsheet(ed_main, "Daily_Main")
@@ -0,0 +1,23 @@
+import os
+import sys
+
+import pytest
+
+# app_v87.py 在專案根目錄 (單一檔案，沒有套件)
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+class FakeClock:
+    """可手動推進的時鐘，注入 SWRStore / TokenBucket / CircuitBreaker；sleep 只記錄秒數"""
+    def __init__(self, now=1000.0):
+        self.now = now
+        self.sleeps = []
+
+    def __call__(self):
+        return self.now
+
+    def sleep(self, sec):
+        self.sleeps.append(sec)
+
+@pytest.fixture
+def clock():
+    return FakeClock()
@@ -0,0 +1,44 @@
+import app_v87 as app
+
+def test_circuit_breaker_opens_after_threshold(clock):
+    breaker = app.CircuitBreaker("t", failure_threshold=2, cooldown=60, clock=clock)
+    breaker.record(False)
+    assert breaker.allow() and not breaker.is_open()
+    breaker.record(False)
+    assert breaker.is_open()
+    assert not breaker.allow()
+    assert breaker.stats()["trips"] == 1 and breaker.stats()["skipped"] == 1
+
+def test_circuit_breaker_success_resets_failures(clock):
+    breaker = app.CircuitBreaker("t", failure_threshold=2, cooldown=60, clock=clock)
+    breaker.record(False)
+    breaker.record(True)
+    breaker.record(False)
+    assert breaker.allow() and breaker.stats()["state"] == "closed"
+
+def test_circuit_breaker_half_open_allows_single_probe(clock):
+    breaker = app.CircuitBreaker("t", failure_threshold=1, cooldown=60, clock=clock)
+    breaker.record(False)
+    clock.now += 61
+    assert not breaker.is_open()
+    assert breaker.allow()
+    assert not breaker.allow()  # 試探中，其他呼叫端仍被擋下
+    breaker.record(True)
+    assert breaker.allow() and breaker.stats()["state"] == "closed"
+
+def test_circuit_breaker_failed_probe_reopens(clock):
+    breaker = app.CircuitBreaker("t", failure_threshold=3, cooldown=60, clock=clock)
+    for _ in range(3): breaker.record(False)
+    clock.now += 61
+    assert breaker.allow()
+    breaker.record(False)
+    assert breaker.is_open() and not breaker.allow()
+    assert breaker.stats()["trips"] == 1
+
+def test_circuit_breaker_unreported_probe_is_retried_next_cooldown(clock):
+    breaker = app.CircuitBreaker("t", failure_threshold=1, cooldown=60, clock=clock)
+    breaker.record(False)
+    clock.now += 61
+    assert breaker.allow()
+    clock.now += 61
+    assert breaker.allow()
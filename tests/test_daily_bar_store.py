@@ -0,0 +1,95 @@
+from datetime import date
+
+import pandas as pd
+import pytest
+
+import app_v87 as app
+
+TODAY = date(2026, 10, 14) # 週三
+TRADING_DAYS = [d.strftime('%Y-%m-%d') for d in pd.bdate_range("2026-10-01", TODAY)]
+
+class FakeDownloader:
+    """取代 download_bars：回傳 days 裡落在 [start, end) 的日K，failing 的 ticker 回報為失敗"""
+    def __init__(self, days):
+        self.days = days
+        self.failing = set()
+        self.calls = []
+
+    def __call__(self, tickers, failed=None, start=None, end=None):
+        self.calls.append((sorted(tickers), start, end))
+        if failed is not None: failed.extend(t for t in tickers if t in self.failing)
+        rows = [(t, pd.Timestamp(d), 1.0, 2.0, 0.5, 1.5, 100.0)
+                for t in tickers if t not in self.failing
+                for d in self.days.get(t, []) if start <= d < end]
+        return pd.DataFrame(rows, columns=['ticker', 'Date', *app.BAR_COLUMNS])
+
+@pytest.fixture
+def download(monkeypatch):
+    fake = FakeDownloader({"A.TW": TRADING_DAYS, "B.TW": TRADING_DAYS})
+    monkeypatch.setattr(app, 'download_bars', fake)
+    monkeypatch.setattr(app, '_tw_today', lambda: TODAY)
+    monkeypatch.setattr(app, '_last_session_day', lambda ticker, now=None: TODAY)
+    return fake
+
+@pytest.fixture
+def store(tmp_path):
+    return app.DailyBarStore(path=str(tmp_path / "daily_bars.sqlite"))
+
+def coverage(store, ticker):
+    return store._coverage([ticker]).get(ticker)
+
+def test_covered_range_is_served_from_disk(store, download):
+    first = store.get_bars(["A.TW"], "2026-10-05", "2026-10-09")
+    assert download.calls == [(["A.TW"], "2026-10-05", "2026-10-10")]
+    assert coverage(store, "A.TW") == (date(2026, 10, 5), date(2026, 10, 9))
+    second = store.get_bars(["A.TW"], "2026-10-06", "2026-10-08")
+    assert len(download.calls) == 1
+    assert list(second["A.TW"].index) == list(first["A.TW"].index[1:4])
+
+def test_today_is_never_covered(store, download):
+    store.get_bars(["A.TW"], "2026-10-12")
+    assert coverage(store, "A.TW") == (date(2026, 10, 12), date(2026, 10, 13))
+    bars = store.get_bars(["A.TW"], "2026-10-12")
+    # 今天的 K 棒還沒定案：只重抓今天這一根
+    assert download.calls == [(["A.TW"], "2026-10-12", "2026-10-15"), (["A.TW"], "2026-10-14", "2026-10-15")]
+    assert len(bars["A.TW"]) == 3
+
+def test_only_today_records_no_coverage(store, download):
+    store.get_bars(["A.TW"], "2026-10-14")
+    assert coverage(store, "A.TW") is None
+
+def test_failed_ticker_is_not_covered(store, download):
+    download.failing = {"B.TW"}
+    bars = store.get_bars(["A.TW", "B.TW"], "2026-10-05", "2026-10-09")
+    assert coverage(store, "A.TW") == (date(2026, 10, 5), date(2026, 10, 9))
+    assert coverage(store, "B.TW") is None
+    assert bars["B.TW"].empty
+    download.failing = set()
+    bars = store.get_bars(["A.TW", "B.TW"], "2026-10-05", "2026-10-09")
+    assert download.calls[-1] == (["B.TW"], "2026-10-05", "2026-10-10")
+    assert len(bars["B.TW"]) == 5
+
+def test_ticker_without_data_is_covered(store, download):
+    # 沒出錯、只是這段沒成交 (停牌)：整批都沒資料也要記 coverage，不必每次重抓
+    store.get_bars(["HALT.TW"], "2026-10-05", "2026-10-09")
+    assert coverage(store, "HALT.TW") == (date(2026, 10, 5), date(2026, 10, 9))
+    store.get_bars(["HALT.TW"], "2026-10-05", "2026-10-09")
+    assert len(download.calls) == 1
+
+def test_coverage_extends_contiguously(store, download):
+    store.get_bars(["A.TW"], "2026-10-05", "2026-10-08")
+    store.get_bars(["A.TW"], "2026-10-01", "2026-10-13")
+    # 只補抓頭尾缺的兩段
+    assert download.calls[1:] == [(["A.TW"], "2026-10-01", "2026-10-05"), (["A.TW"], "2026-10-09", "2026-10-14")]
+    assert coverage(store, "A.TW") == (date(2026, 10, 1), date(2026, 10, 13))
+
+def test_request_past_coverage_fills_the_gap(store, download):
+    store.get_bars(["A.TW"], "2026-10-01", "2026-10-02")
+    store.get_bars(["A.TW"], "2026-10-12", "2026-10-13")
+    # 從覆蓋範圍的尾端接著抓，coverage 中間不會留下沒抓過的空洞
+    assert download.calls[1] == (["A.TW"], "2026-10-03", "2026-10-14")
+    assert coverage(store, "A.TW") == (date(2026, 10, 1), date(2026, 10, 13))
+
+def test_tickers_sharing_a_range_download_together(store, download):
+    store.get_bars(["A.TW", "B.TW"], "2026-10-05", "2026-10-09")
+    assert download.calls == [(["A.TW", "B.TW"], "2026-10-05", "2026-10-10")]
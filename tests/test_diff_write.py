@@ -0,0 +1,27 @@
+import app_v87 as app
+
+def test_diff_grid_ranges_unchanged():
+    grid = [["日期", "收盤"], ["2026-10-14", "24"]]
+    # 24 與 24.0 在 Google Sheets 上顯示相同，不算變動
+    assert app._diff_grid_ranges(grid, [["日期", "收盤"], ["2026-10-14", 24.0]]) == []
+
+def test_diff_grid_ranges_changed_cells_and_appended_rows():
+    old = [["a", "b", "c"], ["1", "2", "3"]]
+    new = [["a", "b", "c"], ["1", "9", "3"], ["4", "5", "6"]]
+    assert app._diff_grid_ranges(old, new) == [
+        {'range': "B2:B2", 'values': [["9"]]},
+        {'range': "A3:C3", 'values': [["4", "5", "6"]]},
+    ]
+
+def test_diff_grid_ranges_merges_consecutive_rows_with_same_columns():
+    old = [["a", "b"], ["1", "2"], ["3", "4"]]
+    new = [["a", "b"], ["1", "x"], ["3", "y"]]
+    assert app._diff_grid_ranges(old, new) == [{'range': "B2:B3", 'values': [["x"], ["y"]]}]
+
+def test_diff_grid_ranges_blanks_removed_rows_and_columns():
+    old = [["a", "b", "c"], ["1", "2", "3"]]
+    new = [["a", "b"]]
+    assert app._diff_grid_ranges(old, new) == [
+        {'range': "C1:C1", 'values': [[""]]},
+        {'range': "A2:C2", 'values': [["", "", ""]]},
+    ]
@@ -0,0 +1,72 @@
+import json
+
+import pandas as pd
+import pytest
+
+import app_v87 as app
+
+@pytest.fixture
+def resolver(tmp_path):
+    return app.ExchangeResolver(path=str(tmp_path / "exchange_map.json"))
+
+def test_candidates_use_seeds_and_try_both_for_unknown(resolver):
+    assert resolver.candidates(["2330", "8299", "0000"]) == {
+        "2330": ["2330.TW"],
+        "8299": ["8299.TWO"],
+        "0000": ["0000.TW", "0000.TWO"],
+    }
+
+def test_observe_without_data_demotes_seed(resolver):
+    resolver.observe("8299.TWO", False)
+    assert resolver.candidates(["8299"]) == {"8299": ["8299.TW", "8299.TWO"]}
+
+def test_observe_with_data_confirms_and_persists(resolver, tmp_path):
+    resolver.observe("2330.TWO", True)
+    resolver.observe("2330.TWO", False)  # 已確認的不會因為某天沒資料被改掉
+    assert resolver.candidates(["2330"]) == {"2330": ["2330.TWO"]}
+    resolver.flush()
+    path = tmp_path / "exchange_map.json"
+    assert json.loads(path.read_text(encoding='utf-8')) == {"2330": ".TWO"}
+    assert app.ExchangeResolver(path=str(path)).candidates(["2330"]) == {"2330": ["2330.TWO"]}
+
+def test_flush_skips_write_when_nothing_confirmed(resolver, tmp_path):
+    resolver.observe("8299.TWO", False)  # 只退回種子，不算確認
+    resolver.flush()
+    assert not (tmp_path / "exchange_map.json").exists()
+
+def test_learn_markets(resolver):
+    resolver.learn_markets(["8299"], "上市")
+    resolver.learn_markets(["2330"], "興櫃")
+    assert resolver.candidates(["8299", "2330"]) == {"8299": ["8299.TW"], "2330": ["2330.TW"]}
+
+def test_alternate(resolver):
+    assert resolver.alternate("2330", ["2330.TW"]) == "2330.TWO"
+    assert resolver.alternate("0000", ["0000.TW", "0000.TWO"]) is None
+    resolver.observe("2330.TW", True)
+    assert resolver.alternate("2330", ["2330.TW"]) is None
+
+def test_fetch_with_exchange_fallback_retries_other_suffix(resolver):
+    listed = {"8299.TW", "2330.TW"}  # 8299 的種子猜上櫃，實際上市
+    calls = []
+
+    def fetch(tickers):
+        calls.append(list(tickers))
+        return {t: pd.DataFrame({"Close": [1.0]} if t in listed else {}) for t in tickers}
+
+    bars, candidates = app.fetch_with_exchange_fallback(resolver, resolver.candidates(["2330", "8299"]), fetch)
+    assert calls == [["2330.TW", "8299.TWO"], ["8299.TW"]]
+    assert candidates == {"2330": ["2330.TW"], "8299": ["8299.TWO", "8299.TW"]}
+    assert not bars["8299.TW"].empty
+    assert resolver.candidates(["8299"]) == {"8299": ["8299.TW"]}
+
+def test_fetch_with_exchange_fallback_skips_confirmed_codes(resolver):
+    resolver.observe("2330.TW", True)
+    calls = []
+
+    def fetch(tickers):
+        calls.append(list(tickers))
+        return {}
+
+    bars, candidates = app.fetch_with_exchange_fallback(resolver, resolver.candidates(["2330"]), fetch)
+    assert calls == [["2330.TW"]]
+    assert bars == {} and candidates == {"2330": ["2330.TW"]}
@@ -0,0 +1,38 @@
+import pandas as pd
+import pytest
+
+import app_v87 as app
+
+@pytest.fixture
+def history(tmp_path):
+    return app.FearGreedHistory(path=str(tmp_path / "fear_greed.sqlite"))
+
+def test_fear_greed_merge_counts_only_changes(history):
+    assert history.last_ts() is None
+    assert history.merge([(300, 30.0), (100, 10.0), (200, 20.0)]) == 3
+    assert history.merge([(200, 20.0), (300, 30.0)]) == 0
+    assert history.merge([(200, 25.0), (400, 40.0), (150, 15.0)]) == 3
+    assert history.last_ts() == 400
+    assert history.series()["score"].tolist() == [10.0, 15.0, 25.0, 30.0, 40.0]
+
+def test_fear_greed_nearest(history):
+    assert history.nearest(100) is None
+    history.merge([(100, 10.0), (200, 20.0), (400, 40.0)])
+    assert history.nearest(0) == (100, 10.0)
+    assert history.nearest(160) == (200, 20.0)
+    assert history.nearest(150) == (100, 10.0)  # 距離相同取較早的一點
+    assert history.nearest(200) == (200, 20.0)
+    assert history.nearest(1000) == (400, 40.0)
+
+def test_fear_greed_series_since(history):
+    history.merge([(100, 10.0), (200, 20.0), (300, 30.0)])
+    df = history.series(since_ts=200)
+    assert df["score"].tolist() == [20.0, 30.0]
+    assert df["date"].tolist() == list(pd.to_datetime([200, 300], unit='ms'))
+    assert history.series(since_ts=1000).empty
+
+def test_fear_greed_history_persists(history, tmp_path):
+    history.merge([(100, 10.0), (200, 20.0)])
+    reloaded = app.FearGreedHistory(path=str(tmp_path / "fear_greed.sqlite"))
+    assert reloaded.last_ts() == 200
+    assert reloaded.nearest(190) == (200, 20.0)
@@ -0,0 +1,63 @@
+from types import SimpleNamespace
+
+import pytest
+
+import app_v87 as app
+
+class FakeSpreadsheet:
+    def __init__(self):
+        self.worksheet_calls = []
+
+    def worksheet(self, name):
+        self.worksheet_calls.append(name)
+        return SimpleNamespace(title=name)
+
+class FakeClient:
+    def __init__(self):
+        self.opened = []
+
+    def open(self, name):
+        sheet = FakeSpreadsheet()
+        self.opened.append((name, sheet))
+        return sheet
+
+@pytest.fixture
+def clients(monkeypatch):
+    """替換 app_v87 內的 st / 憑證 / gspread 名稱，回傳每次授權建立的 FakeClient"""
+    created = []
+
+    def authorize(creds):
+        created.append(FakeClient())
+        return created[-1]
+
+    monkeypatch.setattr(app, 'st', SimpleNamespace(secrets={"gcp_service_account": {}, "sheet_name": "StockTrack"}))
+    monkeypatch.setattr(app, 'ServiceAccountCredentials', SimpleNamespace(from_json_keyfile_dict=lambda info, scope: "creds"))
+    monkeypatch.setattr(app, 'gspread', SimpleNamespace(authorize=authorize))
+    return created
+
+def test_get_worksheet_reuses_cached_handle(clients):
+    manager = app.GSheetConnectionManager()
+    ws = manager.get_worksheet("Daily_Main")
+    assert manager.get_worksheet("Daily_Main") is ws
+    manager.get_worksheet("TAIEX")
+    assert len(clients) == 1
+    (name, sheet), = clients[0].opened
+    assert name == "StockTrack"
+    assert sheet.worksheet_calls == ["Daily_Main", "TAIEX"]
+
+def test_invalidate_drops_client_and_handles(clients):
+    manager = app.GSheetConnectionManager()
+    ws = manager.get_worksheet("Daily_Main")
+    manager.set_snapshot("Daily_Main", [["date"], ["2026-10-14"]], revision="r1")
+    manager.invalidate()
+    assert manager.get_snapshot("Daily_Main") is None
+    assert manager.get_worksheet("Daily_Main") is not ws
+    assert len(clients) == 2
+    assert clients[1].opened[0][1].worksheet_calls == ["Daily_Main"]
+
+def test_write_lock_survives_invalidate(clients):
+    manager = app.GSheetConnectionManager()
+    lock = manager.write_lock("Daily_Main")
+    manager.invalidate()
+    assert manager.write_lock("Daily_Main") is lock
+    assert manager.write_lock("TAIEX") is not lock
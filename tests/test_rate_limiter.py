@@ -0,0 +1,26 @@
+import app_v87 as app
+
+def test_token_bucket_burst_then_queues(clock):
+    bucket = app.TokenBucket(rate=2, burst=2, clock=clock, sleep=clock.sleep)
+    assert [bucket.acquire() for _ in range(4)] == [0.0, 0.0, 0.5, 1.0]
+    assert clock.sleeps == [0.5, 1.0]
+    stats = bucket.stats()
+    assert stats["acquired"] == 4 and stats["delayed"] == 2 and stats["queued"] == 0
+
+def test_token_bucket_refills_up_to_burst(clock):
+    bucket = app.TokenBucket(rate=2, burst=2, clock=clock, sleep=clock.sleep)
+    bucket.acquire(); bucket.acquire()
+    clock.now += 10  # 閒置很久也只補滿到 burst
+    assert [bucket.acquire() for _ in range(3)] == [0.0, 0.0, 0.5]
+
+def test_token_bucket_cost_is_capped_at_burst(clock):
+    bucket = app.TokenBucket(rate=1, burst=3, clock=clock, sleep=clock.sleep)
+    assert bucket.acquire(cost=10) == 0.0
+    assert bucket.acquire() == 1.0
+
+def test_rate_limiter_ignores_unknown_hosts(clock):
+    limiter = app.RateLimiter({"a.example": (1, 1)}, clock=clock, sleep=clock.sleep)
+    assert limiter.acquire("b.example") == 0.0
+    limiter.acquire("a.example")
+    assert limiter.acquire("a.example") == 1.0
+    assert [s["host"] for s in limiter.stats()] == ["a.example"]
@@ -0,0 +1,42 @@
+from datetime import datetime
+
+import pytest
+import pytz
+
+import app_v87 as app
+
+TPE = pytz.timezone('Asia/Taipei')
+
+def tpe_ts(*args):
+    return TPE.localize(datetime(*args)).timestamp()
+
+# --- MarketSessionTTL ---
+@pytest.mark.parametrize("now, expected", [
+    (tpe_ts(2026, 10, 14, 10, 0), tpe_ts(2026, 10, 14, 10, 0) + 30),  # 盤中 (週三)
+    (tpe_ts(2026, 10, 14, 8, 0), tpe_ts(2026, 10, 14, 9, 0)),         # 盤前 → 當天開盤
+    (tpe_ts(2026, 10, 14, 13, 35), tpe_ts(2026, 10, 14, 13, 40)),     # 收盤後 → 定案抓取
+    (tpe_ts(2026, 10, 14, 14, 0), tpe_ts(2026, 10, 15, 9, 0)),        # 已定案 → 隔天開盤
+    (tpe_ts(2026, 10, 16, 14, 0), tpe_ts(2026, 10, 19, 9, 0)),        # 週五盤後 → 週一開盤
+    (tpe_ts(2026, 10, 17, 10, 0), tpe_ts(2026, 10, 19, 9, 0)),        # 週六 → 週一開盤
+])
+def test_market_session_ttl_expires_at(now, expected):
+    assert app.MarketSessionTTL(30).expires_at(now) == expected
+
+def test_market_session_ttl_session_bounds():
+    ttl = app.MarketSessionTTL(30)
+    # 開盤含 09:00，收盤 13:30 已不算盤中
+    assert ttl.expires_at(tpe_ts(2026, 10, 14, 9, 0)) == tpe_ts(2026, 10, 14, 9, 0) + 30
+    assert ttl.expires_at(tpe_ts(2026, 10, 14, 13, 30)) == tpe_ts(2026, 10, 14, 13, 40)
+
+# --- _swr_expires_at ---
+def test_swr_expires_at_numeric_ttl():
+    assert app._swr_expires_at(300, ("v", 0, 1000, True)) == 1300
+    assert app._swr_expires_at(300, ("v", 0, 1000, False)) == 1000 + app.SWR_RETRY_SEC
+    # ttl 比重試間隔短時不會被拉長
+    assert app._swr_expires_at(10, (None, 0, 1000, False)) == 1010
+
+def test_swr_expires_at_failed_fetch_is_not_held_until_next_open():
+    ttl = app.MarketSessionTTL(30)
+    after_settle = tpe_ts(2026, 10, 14, 14, 0)
+    assert app._swr_expires_at(ttl, ("v", 0, after_settle, True)) == tpe_ts(2026, 10, 15, 9, 0)
+    assert app._swr_expires_at(ttl, (None, 0, after_settle, False)) == after_settle + app.SWR_RETRY_SEC
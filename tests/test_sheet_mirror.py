@@ -0,0 +1,69 @@
+import pytest
+
+import app_v87 as app
+
+@pytest.fixture
+def path(tmp_path):
+    return str(tmp_path / "gsheet_mirror.sqlite")
+
+@pytest.fixture
+def mirror(path):
+    return app.LocalSheetMirror(path)
+
+@pytest.fixture
+def manager(monkeypatch):
+    manager = app.GSheetConnectionManager()
+    monkeypatch.setattr(manager, 'get_revision', lambda: "r2")
+    return manager
+
+def test_versions_bump_on_write_and_drop(mirror):
+    assert mirror.versions_of(["TAIEX", "TPEx"]) == (0, 0)
+    mirror.write("TAIEX", [["日期", "收"], ["2026-10-14", 23000.5]], "r1")
+    assert mirror.versions_of(["TAIEX", "TPEx"]) == (1, 0)
+    assert mirror.read("TAIEX") == ([["日期", "收"], ["2026-10-14", "23000.5"]], "r1")
+    mirror.write("TAIEX", [["日期", "收"]], "r1")
+    mirror.drop("TAIEX")
+    assert mirror.versions_of(["TAIEX"]) == (3,)
+    assert mirror.read("TAIEX") == (None, None)
+
+def test_claim_sync_is_shared_across_instances(path):
+    first, second = app.LocalSheetMirror(path), app.LocalSheetMirror(path)
+    assert first.claim_sync(60)
+    assert not second.claim_sync(60)
+    assert not first.claim_sync(60)
+    assert second.claim_sync(0)
+
+def test_sync_downloads_only_stale_tabs(monkeypatch, mirror, manager):
+    mirror.write("Daily_Main", [["date"], ["2026-10-14"]], "r2")
+    requested = []
+
+    def fetch(names):
+        requested.append(list(names))
+        return {name: [["日期"], [name]] for name in names}
+
+    monkeypatch.setattr(app, 'fetch_sheet_grids', fetch)
+    assert app.sync_sheet_mirror(mirror, manager, force=True) == ["TAIEX", "TPEx"]
+    assert requested == [["TAIEX", "TPEx"]]
+    assert mirror.read("TPEx") == ([["日期"], ["TPEx"]], "r2")
+    assert manager.get_snapshot_revision("TPEx") == "r2"
+    assert mirror.get_meta('revision') == "r2"
+
+def test_sync_respects_claim(monkeypatch, mirror, manager):
+    monkeypatch.setattr(app, 'fetch_sheet_grids', lambda names: {name: [["日期"]] for name in names})
+    assert app.sync_sheet_mirror(mirror, manager)
+    # 同一個間隔內的下一次同步 (例如另一個 replica) 直接略過
+    assert app.sync_sheet_mirror(mirror, manager) == []
+
+def test_local_write_during_download_wins(monkeypatch, mirror, manager):
+    local = [["日期", "收"], ["2026-10-14", "23000"]]
+
+    def fetch(names):
+        # 下載途中本機寫入了 TAIEX：剛抓到的 (較舊) 內容不能蓋掉它
+        mirror.write("TAIEX", local, "r2")
+        return {name: [["日期", "收"], ["2026-10-13", "22900"]] for name in names}
+
+    monkeypatch.setattr(app, 'fetch_sheet_grids', fetch)
+    assert app.sync_sheet_mirror(mirror, manager, force=True) == ["Daily_Main", "TPEx"]
+    assert mirror.read("TAIEX") == (local, "r2")
+    assert manager.get_snapshot("TAIEX") is None
+    assert mirror.read("TPEx")[0][1] == ["2026-10-13", "22900"]
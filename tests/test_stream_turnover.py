@@ -0,0 +1,13 @@
+import app_v87 as app
+
+def test_parse_manual_turnover_indexes_names_and_codes():
+    manual = app.parse_manual_turnover('{"台積電": 350, "8299": "12.5"}')
+    assert manual["台積電"] == manual["2330"] == 350.0
+    assert manual["8299"] == manual["群聯"] == 12.5
+    assert app.parse_manual_turnover(None) == {}
+    assert app.parse_manual_turnover("not json") == {}
+
+def test_stream_turnover_overlays_fetched_values():
+    html = app.render_stock_tags_v113("台積電、群聯", {"台積電": 300.0, "群聯": 10.0}, live={"2330": 320.0})
+    assert "320.0億" in html and "300.0億" not in html
+    assert "10.0億" in html
@@ -0,0 +1,35 @@
+import pandas as pd
+
+import app_v87 as app
+
+def test_swr_is_valid_defaults():
+    assert not app._swr_is_valid(None)
+    assert not app._swr_is_valid([])
+    assert not app._swr_is_valid(pd.DataFrame())
+    assert not app._swr_is_valid({"a": pd.DataFrame(), "b": pd.DataFrame()})
+    assert app._swr_is_valid({"a": pd.DataFrame(), "b": pd.DataFrame({"x": [1]})})
+    assert app._swr_is_valid(0)
+
+def test_swr_put_invalid_keeps_previous_valid_value(clock):
+    store = app.SWRStore(max_entries=4, clock=clock)
+    assert store.put("k", [1, 2], app._swr_is_valid) == ([1, 2], 1000.0, 1000.0, True)
+    clock.now = 1100.0
+    assert store.put("k", None, app._swr_is_valid) == ([1, 2], 1000.0, 1100.0, False)
+    clock.now = 1200.0
+    assert store.put("k", [3], app._swr_is_valid) == ([3], 1200.0, 1200.0, True)
+
+def test_swr_put_invalid_first_value_is_stored(clock):
+    store = app.SWRStore(max_entries=4, clock=clock)
+    assert store.put("k", [], app._swr_is_valid) == ([], 1000.0, 1000.0, False)
+    clock.now = 1100.0
+    # 舊值本來就無效時，以最新的結果為準
+    assert store.put("k", None, app._swr_is_valid) == (None, 1100.0, 1100.0, False)
+
+def test_swr_store_evicts_least_recently_used(clock):
+    store = app.SWRStore(max_entries=2, clock=clock)
+    store.put("a", 1, app._swr_is_valid)
+    store.put("b", 2, app._swr_is_valid)
+    store.get("a")
+    store.put("c", 3, app._swr_is_valid)
+    assert store.get("b") is None
+    assert store.get("a")[0] == 1 and store.get("c")[0] == 3
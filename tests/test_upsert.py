@@ -0,0 +1,102 @@
+import pandas as pd
+import pytest
+
+import app_v87 as app
+
+SHEET = "Daily_Main"
+GRID = [
+    ["date", "wind", "note"],
+    ["2026-10-14", "強風", "a"],
+    ["2026-10-13", "亂流", "b"],
+    ["2026-10-10", "陣風", "c"],
+]
+
+class FakeWorksheet:
+    """只記錄 batch_update / insert_rows / add_cols 呼叫"""
+    def __init__(self):
+        self.row_count = 1000
+        self.col_count = 3
+        self.calls = []
+
+    def batch_update(self, data):
+        self.calls.append(("batch_update", data))
+
+    def insert_rows(self, values, row):
+        self.calls.append(("insert_rows", values, row))
+
+    def add_cols(self, n):
+        self.col_count += n
+        self.calls.append(("add_cols", n))
+
+@pytest.fixture
+def sheet(monkeypatch, tmp_path):
+    ws = FakeWorksheet()
+    manager = app.GSheetConnectionManager()
+    manager._worksheets[SHEET] = ws
+    monkeypatch.setattr(manager, 'get_revision', lambda: "r1")
+    manager.set_snapshot(SHEET, GRID, "r1")
+    mirror = app.LocalSheetMirror(str(tmp_path / "mirror.sqlite"))
+    monkeypatch.setattr(app, 'get_gsheet_manager', lambda: manager)
+    monkeypatch.setattr(app, 'get_sheet_mirror', lambda: mirror)
+    return ws, manager, mirror
+
+def upsert(rows, columns=("date", "wind", "note")):
+    ok, msg = app.upsert_rows_by_key(pd.DataFrame(rows, columns=list(columns)), SHEET)
+    assert ok, msg
+
+def test_upsert_overwrites_existing_date(sheet):
+    ws, manager, mirror = sheet
+    upsert([["2026/10/13", "颱風", "x"]])  # 日期格式不同也要對到同一列
+    assert ws.calls == [("batch_update", [{'range': "A3:C3", 'values': [["2026-10-13", "颱風", "x"]]}])]
+    expected = [GRID[0], GRID[1], ["2026-10-13", "颱風", "x"], GRID[3]]
+    assert manager.get_snapshot(SHEET) == expected
+    assert mirror.read(SHEET) == (expected, "r1")
+    assert manager.get_key_index(SHEET, "date", "r1")[1] == ["2026-10-14", "2026-10-13", "2026-10-10"]
+
+def test_upsert_inserts_newest_date_at_top(sheet):
+    ws, manager, mirror = sheet
+    upsert([["2026-10-15", "微風", "n"]])
+    assert ws.calls == [("insert_rows", [["2026-10-15", "微風", "n"]], 2)]
+    assert manager.get_snapshot(SHEET) == [GRID[0], ["2026-10-15", "微風", "n"]] + GRID[1:]
+    assert manager.get_key_index(SHEET, "date", "r1")[1] == ["2026-10-15", "2026-10-14", "2026-10-13", "2026-10-10"]
+
+def test_upsert_inserts_between_dates(sheet):
+    ws, manager, mirror = sheet
+    upsert([["2026-10-12", "無風", "m"]])
+    assert ws.calls == [("insert_rows", [["2026-10-12", "無風", "m"]], 4)]
+    assert manager.get_snapshot(SHEET) == GRID[:3] + [["2026-10-12", "無風", "m"], GRID[3]]
+
+def test_upsert_mixed_inserts_run_bottom_up(sheet):
+    ws, manager, mirror = sheet
+    upsert([["2026-10-15", "微風", "n"], ["2026-10-13", "颱風", "x"], ["2026-10-11", "無風", "m"], ["2026-10-12", "陣風", "p"]])
+    assert ws.calls == [
+        ("batch_update", [{'range': "A3:C3", 'values': [["2026-10-13", "颱風", "x"]]}]),
+        # 下方的插入先做，上方的列號才不會位移；同一位置的一組依新到舊排列
+        ("insert_rows", [["2026-10-12", "陣風", "p"], ["2026-10-11", "無風", "m"]], 4),
+        ("insert_rows", [["2026-10-15", "微風", "n"]], 2),
+    ]
+    assert manager.get_snapshot(SHEET) == [
+        GRID[0],
+        ["2026-10-15", "微風", "n"],
+        GRID[1],
+        ["2026-10-13", "颱風", "x"],
+        ["2026-10-12", "陣風", "p"],
+        ["2026-10-11", "無風", "m"],
+        GRID[3],
+    ]
+
+def test_upsert_appends_new_columns_to_header(sheet):
+    ws, manager, mirror = sheet
+    upsert([["2026-10-14", "強風", "a", "18.5"]], columns=("date", "wind", "note", "vix"))
+    assert ws.calls == [
+        ("add_cols", 1),
+        ("batch_update", [
+            {'range': "D1:D1", 'values': [["vix"]]},
+            {'range': "A2:D2", 'values': [["2026-10-14", "強風", "a", "18.5"]]},
+        ]),
+    ]
+    snapshot = manager.get_snapshot(SHEET)
+    assert snapshot[0] == ["date", "wind", "note", "vix"]
+    assert snapshot[1] == ["2026-10-14", "強風", "a", "18.5"]
+    assert snapshot[2:] == GRID[2:]
+    assert manager.get_key_index(SHEET, "date", "r1")[0] == ["date", "wind", "note", "vix"]
@@ -0,0 +1,41 @@
+import pytest
+
+import app_v87 as app
+
+HEADER = ["名次", "股名/股號", "股價", "漲跌", "漲跌幅(%)", "成交量", "成交值(億)"]
+ROWS = [
+    ["1", "2330\n    台積電", "1,050.00", "▲10.00", "▲0.96%", "40,000", "420.5"],
+    ["2", "2317&nbsp; 鴻海", "210.50", "▼1.00", "▼0.47%", "90,000", "190.2"],
+    ["3", "9999 停牌股", "--", "--", "--", "0", "0"],
+]
+
+def rank_html(header_cell):
+    head = "".join(f"<{header_cell}>{c}</{header_cell}>" for c in HEADER)
+    body = "".join("<tr>" + "".join(f"<td>{c}</td>" for c in row) + "</tr>" for row in ROWS)
+    return f"<html><body><table><thead><tr>{head}</tr></thead><tbody>{body}</tbody></table></body></html>"
+
+@pytest.fixture(autouse=True)
+def resolver(monkeypatch, tmp_path):
+    resolver = app.ExchangeResolver(path=str(tmp_path / "exchange_map.json"))
+    monkeypatch.setattr(app, 'get_exchange_resolver', lambda: resolver)
+    return resolver
+
+# 表頭是 <th>：XPath 直接找到成交值那張表；表頭是 <td>：退回 pd.read_html
+@pytest.mark.parametrize("header_cell", ["th", "td"])
+def test_parse_yahoo_rank_page(header_cell, resolver):
+    out = app._parse_yahoo_rank_page(rank_html(header_cell), "上櫃")
+    assert out["代號"].tolist() == ["2330", "2317"]
+    assert out["名稱"].tolist() == ["台積電", "鴻海"]
+    assert out["族群"].tolist() == ["晶圓代工", "AI伺服器組裝代工"]
+    assert out["股價"].tolist() == [1050.0, 210.5]
+    assert out["漲跌幅%"].tolist() == [0.96, -0.47]
+    assert out["成交值(億)"].tolist() == [420.5, 190.2]
+    assert set(out["市場"]) == {"上櫃"} and set(out["來源"]) == {"Yahoo"}
+    assert resolver.candidates(["2330"]) == {"2330": ["2330.TWO"]}
+
+def test_html_cell_text_collapses_whitespace():
+    cell = app.lxml.html.fromstring("<td>2330\r\n \t台積電&nbsp;&nbsp;</td>")
+    assert app._html_cell_text(cell) == "2330 台積電"
+
+def test_find_yahoo_rank_table_without_turnover_column():
+    assert app._find_yahoo_rank_table("<table><tr><th>股名</th></tr><tr><td>2330</td></tr></table>") is None